@@ -1,22 +1,78 @@
 from tqdm import tqdm
 from cassandra.cluster import Cluster
-from cassandra.query import BatchStatement
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType
 import os
-from array import array
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from trace_reader import BLOCK_SIZE, split_address
+from line_state import trace_batches, check_delta
+
+SCHEMAS = ('byte', 'block', 'bucket')
+
+# Rows per single-partition UNLOGGED batch, keeps batches below the server's batch size warning
+MAX_PARTITION_BATCH = 128
 
 class BinaryFileParserCassandra:
-    def __init__(self, host, keyspace, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt'):
+    def __init__(self, host, keyspace, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt',
+                 schema='byte', delta=False, keep_first_write=True, concurrency=64, group_partitions=True,
+                 bucket_size=2**16):
+        if schema not in SCHEMAS:
+            raise ValueError(f"Unknown schema {schema!r}, expected one of {SCHEMAS}")
+        check_delta(delta, schema != 'byte')
+        self.delta = delta  # Per-byte rows only hold changed bytes, see line_state.trace_batches
+        self.keep_first_write = keep_first_write
         self.host = host
+        # 'byte' (row per byte), 'block' (row per writeback) or 'bucket' (row per writeback,
+        # partitioned by line and bucket_size consecutive timestamps)
+        self.schema = schema
+        self.bucket_size = bucket_size
         self.keyspace = keyspace
         self.batch_size = batch_size
         self.NUM_BLOCK_PROCESS = num_block_process
         self.checkpoint_file = checkpoint_file
+        self.concurrency = concurrency  # Requests in flight at once
+        self.group_partitions = group_partitions  # Rows of one partition go out as one UNLOGGED batch
+        self.prepared = {}
         self.cluster = Cluster([self.host])
         self.session = self.cluster.connect()
         self.session.set_keyspace(self.keyspace)
 
     def create_table(self):
         """Create a table for storing address data in Cassandra."""
+        if self.schema == 'block':
+            # One row per writeback, the history of a line is a single partition
+            self.session.execute("""
+                CREATE TABLE IF NOT EXISTS address_blocks (
+                    line_address bigint,
+                    timestamp bigint,
+                    data blob,
+                    PRIMARY KEY (line_address, timestamp)
+                )
+            """)
+            return
+        if self.schema == 'bucket':
+            # A partition holds at most bucket_size writebacks of a line, however hot the line is
+            self.session.execute("""
+                CREATE TABLE IF NOT EXISTS line_history (
+                    line_address bigint,
+                    bucket bigint,
+                    timestamp bigint,
+                    data blob,
+                    PRIMARY KEY ((line_address, bucket), timestamp)
+                )
+            """)
+            # Buckets each line has rows in, so reads only fan out to partitions that exist
+            self.session.execute("""
+                CREATE TABLE IF NOT EXISTS line_buckets (
+                    line_address bigint,
+                    bucket bigint,
+                    PRIMARY KEY (line_address, bucket)
+                )
+            """)
+            return
         self.session.execute("""
             CREATE TABLE IF NOT EXISTS address_data (
                 address bigint,
@@ -38,63 +94,152 @@ class BinaryFileParserCassandra:
         with open(self.checkpoint_file, 'w') as f:
             f.write(str(last_processed_index))
 
-    def parse_binary_file(self, fp):
-        """Read and parse a 72-byte block from the binary file to extract address and data."""
-        data = fp.read(8)
-        if len(data) != 8:
-            raise ValueError("Invalid data size. Expected 8 bytes for address.")
-        address = int.from_bytes(data, byteorder='little')
+    def iter_trace(self, file_path, start=0, stop=None, follow=False, poll_interval=1.0, idle_timeout=None):
+        """Batches of blocks [start, stop) shaped for the configured schema, see line_state.trace_batches."""
+        # Timestamps are labelled T1, T2, etc. (plain 1, 2, etc. in the block and bucket schemas)
+        return trace_batches(file_path, self.batch_size, start, stop, self.schema in ('block', 'bucket'), self.delta,
+                             self.keep_first_write, 1, follow, poll_interval, idle_timeout)
 
-        data = array('B', fp.read(64))
-        length = len(data)
-        return [(address + i, data[i]) for i in range(length)]
+    def load_data_from_file(self, file_path, follow=False, poll_interval=1.0, idle_timeout=None):
+        """Load and process blocks from a binary file and store address values in Cassandra.
 
-    def load_data_from_file(self, file_path):
-        """Load and process blocks from a binary file and store address values in Cassandra."""
+        With follow, keep loading new blocks while the simulation is still writing the trace, until
+        idle_timeout seconds pass without any (forever when None). NUM_BLOCK_PROCESS is ignored then.
+        """
         last_processed_index = self.get_checkpoint()
-        with open(file_path, 'rb') as fp:
+        if follow:
+            num_blocks = None
+            batches = self.iter_trace(file_path, last_processed_index, None, True, poll_interval, idle_timeout)
+        else:
             file_size = os.path.getsize(file_path)
-            num_blocks = max(file_size // 72, self.NUM_BLOCK_PROCESS)
-
-            # Move the file pointer to the last processed block
-            fp.seek(last_processed_index * 72)
-
-            with tqdm(total=num_blocks, desc="Inserting Blocks into Database", initial=last_processed_index) as pbar:
-                batch_data = []
-                try:
-                    index = last_processed_index
-                    timestamp_counter = index + 1  # Start counter for timestamps as T1, T2, etc.
-                    while index < num_blocks:
-                        data_value = self.parse_binary_file(fp)
-                        for address, value in data_value:
-                            timestamp_label = f"T{timestamp_counter}"
-                            batch_data.append((address, timestamp_label, value))
-
-                        if len(batch_data) >= self.batch_size:
-                            self.bulk_insert(batch_data)
-                            batch_data.clear()
-                            self.update_checkpoint(index + 1)
-
-                        pbar.update(1)
-                        index += 1
-                        timestamp_counter += 1
-
-                    if batch_data:
-                        self.bulk_insert(batch_data)
-                        self.update_checkpoint(index)
-                except Exception as e:
-                    print(f"Error or End of File: {e}")
-
-    def bulk_insert(self, batch_data):
-        """Perform a batch insert of address data into Cassandra."""
-        query = """
-            INSERT INTO address_data (address, timestamp, value)
-            VALUES (%s, %s, %s)
+            num_blocks = min(file_size // BLOCK_SIZE, self.NUM_BLOCK_PROCESS)
+            batches = self.iter_trace(file_path, last_processed_index, num_blocks)
+
+        with tqdm(total=num_blocks, desc="Inserting Blocks into Database", initial=last_processed_index) as pbar:
+            try:
+                for batch in batches:
+                    if self.schema == 'block':
+                        self.insert_blocks(batch)
+                    elif self.schema == 'bucket':
+                        self.insert_line_buckets(batch)
+                    else:
+                        self.bulk_insert(batch)
+                    self.update_checkpoint(batch.stop)
+                    pbar.update(batch.stop - batch.start)
+            except Exception as e:
+                print(f"Error or End of File: {e}")
+
+    def prepare(self, query):
+        """Prepared statement of a query, prepared once per session."""
+        if query not in self.prepared:
+            self.prepared[query] = self.session.prepare(query)
+        return self.prepared[query]
+
+    def execute_rows(self, statement, partition_keys, rows):
+        """Execute a prepared statement for every row, with at most self.concurrency requests in flight.
+
+        partition_keys is an array, or a tuple of arrays for a composite key, with one entry per row.
+        """
+        if not rows:
+            return
+        if not self.group_partitions:
+            execute_concurrent_with_args(self.session, statement, rows, concurrency=self.concurrency)
+            return
+
+        # Group rows by partition key, a batch never spans partitions so no coordinator fans it out
+        if not isinstance(partition_keys, tuple):
+            partition_keys = (partition_keys,)
+        order = np.lexsort(partition_keys[::-1])
+        new_partition = np.zeros(len(order), dtype=bool)
+        new_partition[0] = True
+        for keys in partition_keys:
+            sorted_keys = keys[order]
+            new_partition[1:] |= sorted_keys[1:] != sorted_keys[:-1]
+        starts = np.flatnonzero(new_partition)
+        bounds = starts.tolist() + [len(order)]
+        order = order.tolist()
+
+        requests = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if hi - lo == 1:
+                requests.append((statement, rows[order[lo]]))
+                continue
+            for first in range(lo, hi, MAX_PARTITION_BATCH):
+                batch_statement = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for i in order[first:min(first + MAX_PARTITION_BATCH, hi)]:
+                    batch_statement.add(statement, rows[i])
+                requests.append((batch_statement, None))
+        execute_concurrent(self.session, requests, concurrency=self.concurrency)
+
+    def bulk_insert(self, batch):
+        """Insert the address data rows of a batch into Cassandra."""
+        statement = self.prepare("INSERT INTO address_data (address, timestamp, value) VALUES (?, ?, ?)")
+        rows = [(address, f"T{timestamp}", value) for address, timestamp, value
+                in zip(batch.address.tolist(), batch.timestamp.tolist(), batch.value.tolist())]
+        self.execute_rows(statement, batch.address, rows)
+
+    def insert_blocks(self, batch):
+        """Insert whole writebacks into Cassandra."""
+        statement = self.prepare("INSERT INTO address_blocks (line_address, timestamp, data) VALUES (?, ?, ?)")
+        rows = [(address, timestamp, line.tobytes())
+                for address, timestamp, line in zip(batch.address.tolist(), batch.timestamp.tolist(), batch.data)]
+        self.execute_rows(statement, batch.address, rows)
+
+    def insert_line_buckets(self, batch):
+        """Insert whole writebacks into their (line address, bucket) partitions."""
+        bucket = batch.timestamp // self.bucket_size
+        statement = self.prepare(
+            "INSERT INTO line_history (line_address, bucket, timestamp, data) VALUES (?, ?, ?, ?)"
+        )
+        rows = [(address, bucket_id, timestamp, line.tobytes()) for address, bucket_id, timestamp, line
+                in zip(batch.address.tolist(), bucket.tolist(), batch.timestamp.tolist(), batch.data)]
+        self.execute_rows(statement, (batch.address, bucket), rows)
+
+        # Register every bucket the batch touched, rewriting a known one is a no-op
+        touched = np.unique(np.stack((batch.address.astype(np.int64), bucket)), axis=1)
+        statement = self.prepare("INSERT INTO line_buckets (line_address, bucket) VALUES (?, ?)")
+        self.execute_rows(statement, touched[0], list(zip(touched[0].tolist(), touched[1].tolist())))
+
+    def fetch_line_history(self, line_address, t_from=0, t_to=2**63 - 1):
+        """Return the (timestamp, 64 data bytes) writebacks of a line with t_from <= timestamp < t_to.
+
+        The buckets in range are read in parallel, with at most self.concurrency requests in flight.
         """
-        batch = BatchStatement()
-        for address, timestamp, value in batch_data:
-            batch.add(query, (address, timestamp, value))
-        self.session.execute(batch)
+        if t_to <= t_from:
+            return []
+        buckets = self.session.execute(
+            self.prepare("SELECT bucket FROM line_buckets WHERE line_address = ? AND bucket >= ? AND bucket <= ?"),
+            (line_address, t_from // self.bucket_size, (t_to - 1) // self.bucket_size)
+        )
+        statement = self.prepare(
+            "SELECT timestamp, data FROM line_history "
+            "WHERE line_address = ? AND bucket = ? AND timestamp >= ? AND timestamp < ?"
+        )
+        results = execute_concurrent_with_args(
+            self.session, statement, [(line_address, row.bucket, t_from, t_to) for row in buckets],
+            concurrency=self.concurrency
+        )
+        # Results come back in bucket order and rows in clustering order, so the history is sorted
+        return [(row.timestamp, row.data) for result in results for row in result.result_or_exc]
+
+    def fetch_address_history(self, address):
+        """Return the history of one byte address as (timestamp, value) int pairs in timestamp order.
+
+        Every schema returns the same shape, so histories compare across schemas.
+        """
+        if self.schema == 'bucket':
+            line_address, offset = split_address(address)
+            return [(timestamp, data[offset]) for timestamp, data in self.fetch_line_history(line_address)]
+        if self.schema == 'block':
+            line_address, offset = split_address(address)
+            rows = self.session.execute(
+                "SELECT timestamp, data FROM address_blocks WHERE line_address = %s", (line_address,)
+            )
+            return [(row.timestamp, row.data[offset]) for row in rows]
+
+        # Byte rows store "T{n}" text timestamps, which sort lexicographically, so parse and order them here
+        rows = self.session.execute("SELECT timestamp, value FROM address_data WHERE address = %s", (address,))
+        return sorted((int(row.timestamp[1:]), row.value) for row in rows)
 
     def close(self):
         """Close the database connection."""
@@ -106,7 +251,7 @@ if __name__ == "__main__":
     host = "localhost"  # Cassandra is exposed on localhost:9042
     keyspace = "mykeyspace"
 
-    parser = BinaryFileParserCassandra(host=host, keyspace=keyspace, batch_size=50, num_block_process=100000)
+    parser = BinaryFileParserCassandra(host=host, keyspace=keyspace, batch_size=50, num_block_process=2**60)
     parser.create_table()
     parser.load_data_from_file("./../script/data.log")
     parser.close()
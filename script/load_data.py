@@ -82,19 +82,26 @@ class BinaryFileParser:
             psycopg2.extras.execute_values(cur, insert_query, batch_data)
             self.conn.commit()
 
-    def fetch_all_data(self):
+    def fetch_all_data(self, itersize=2**16):
         """Fetch all data entries from PostgreSQL and display progress with tqdm."""
         with self.conn.cursor() as cur:
             cur.execute("SELECT COUNT(*) FROM AddressData")
             total_entries = cur.fetchone()[0]  # Get total number of rows
 
-            with tqdm(total=total_entries, desc="Fetching Records") as pbar:
+        # A named cursor keeps the result on the server and fetches itersize rows per round trip,
+        # so the rows are counted and printed in one pass without holding them all in memory
+        nonzero = 0
+        with tqdm(total=total_entries, desc="Fetching Records") as pbar:
+            with self.conn.cursor(name='fetch_all_data') as cur:
+                cur.itersize = itersize
                 cur.execute("SELECT * FROM AddressData")
-                print("Length : ", len([r for r in cur if r[2] != 0]))
                 for row in cur:
                     # Process each row (e.g., print or store in a variable)
                     print(row)
+                    nonzero += row[2] != 0
                     pbar.update(1)  # Update the progress bar for each record fetched
+        self.conn.rollback()  # End the read transaction the named cursor ran in
+        print("Length : ", nonzero)
 
     def close(self):
         """Close the database connection."""
@@ -1,97 +1,305 @@
 import tkinter as tk
 from tkinter import messagebox
-from array import array
+import os
+import stat
+import sys
+import threading
+import time
+import numpy as np
 
-class AddressManager:
-    def __init__(self):
-        self.address_dict = {}  # Store current values
-        self.left_stack = []    # Store historical changes (previous values)
-        self.value_history = {} # Store all values for each address with timestamps
-        self.NUM = 2 ** 10
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from trace_reader import LINE_SIZE, TraceReader, split_address, follow_block_batches
+from line_state import SnapshotIndex
+from line_index import LineIndex, open_index
+from memory_image import write_image
+
+_LINE_OFFSETS = np.arange(LINE_SIZE, dtype=np.uint64)
 
-    def parse_binary_file2(self, fp):
-        """Read and parse the binary file to extract address and data."""
-        data = fp.read(8)
+def parse_address(text):
+    """Parse an address typed as 0x/0o/0b-prefixed or plain decimal, leading zeros included."""
+    try:
+        return int(text, 0)
+    except ValueError:
+        # Base 0 rejects decimals with leading zeros such as 010
+        return int(text, 10)
 
-        if len(data) != 8:
-            raise ValueError("Invalid data size. Expected 16 bytes.")
 
-        address = int.from_bytes(data, byteorder='little')
+class AddressManager:
+    def __init__(self, delta_only=False, keep_first_write=True):
+        # Columnar state, one entry per writeback block; the block index is the timestamp
+        self.block_address = np.empty(0, dtype=np.uint64)             # Line address of each block
+        self.block_data = np.empty((0, LINE_SIZE), dtype=np.uint8)     # 64 data bytes of each block
+        self.prev_block = None  # Previous block of the same line, -1 if none (undo log), built on first use
 
-        # Use array for efficient storage of 8-bit integers
-        data = array('B')
-        for _ in range(64):
-            d = fp.read(1)
-            if not d:
-                raise ValueError("Unexpected EOF")
-            data.append(d[0])  # Directly append byte value
+        self.index = LineIndex()  # Block indices grouped by line address
 
-        return [(address + i, data[i]) for i in range(64)]
+        self.NUM = None  # Optional cap on the number of blocks to load
+        self.snapshots = SnapshotIndex()  # Periodic snapshots for memory_at
+        self.delta_only = delta_only  # History only lists the writebacks that changed a byte
+        self.keep_first_write = keep_first_write  # With delta_only, still list a line's first write
+        self.trace = None
+        # Growable storage of the blocks append_blocks received, block_address and block_data view its prefix
+        self._buffer_address = None
+        self._buffer_data = None
 
     def load_data_from_file(self, file_path):
-        """Load the data from a binary file and update address values."""
-        with open(file_path, 'rb') as fp:
-            try:
-                index  = 0
-                while True and index <= self.NUM:
-                    data_value = self.parse_binary_file2(fp)
-                    data_to_push = array('B')  # Store previous and new values
-                    address_push = data_value[0][0]
-
-                    # Optimize dictionary lookup and update
-                    for address, data in data_value:
-                        prev_data = self.address_dict.get(address, 0x0)  # Get previous value
-                        data_to_push.append(prev_data)  # Store previous value
-                        data_to_push.append(data)       # Store new value
-
-                        # Update value history with timestamp
-                        if address not in self.value_history:
-                            self.value_history[address] = []
-                        timestamp = f"T-{len(self.value_history[address])}"
-                        self.value_history[address].append((timestamp, data))
-
-                    # Update the dictionary
-                    for i, (address, new_data) in enumerate(data_value):
-                        self.address_dict[address] = new_data
-
-                    # Append changes to the left stack
-                    self.left_stack.append((address_push, data_to_push))
-                    index += 1
-            except Exception as e:
-                print(f"Error or End of File: {e}")
+        """Load the data from a binary file and index it by line address."""
+        self.close()
+        # Block data stays in the shared mapping, only the index lives in process memory
+        if self.NUM is None:
+            # The sidecar index makes a restart on an already indexed trace nearly free
+            self.index = open_index(file_path)
+        self.trace = TraceReader(file_path)
+        blocks = self.trace[:self.NUM if self.NUM is not None else self.index.num_blocks]
+        self.block_address = blocks['address']
+        self.block_data = blocks['data']
+        if self.NUM is not None:
+            self.build_index()
+        self.prev_block = None
+
+    def build_index(self):
+        """Group block indices by line address, in time order within each line."""
+        self.index = LineIndex.build(self.block_address)
+
+    def build_snapshots(self):
+        """Derive the undo links and the snapshots for memory_at, once, as they cost a pass over the trace."""
+        if self.prev_block is None:
+            # The previous writeback of each line replaces the (prev, new) pairs of the old left_stack
+            self.prev_block = self.index.prev_blocks()
+            self.snapshots.build(self.block_address, self.prev_block)
+
+    def find_line(self, address):
+        """Position of the line holding address in the index and the byte offset, or None."""
+        line_address, offset = split_address(address)
+        i = self.index.find(line_address)
+        if i < 0:
+            return None
+        return i, offset
+
+    def address_history(self, address):
+        """Block indices and values of every write of address, as arrays."""
+        found = self.find_line(address)
+        if found is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        i, offset = found
+        blocks = self.index.blocks_at(i)
+        values = self.block_data[blocks, offset]
+        if self.delta_only:
+            keep = np.empty(len(values), dtype=bool)
+            keep[0] = self.keep_first_write or values[0] != 0
+            keep[1:] = values[1:] != values[:-1]
+            blocks, values = blocks[keep], values[keep]
+        return blocks, values
+
+    def changes(self, index):
+        """Undo entry of block index: its line address, the previous and the new 64 bytes."""
+        self.build_snapshots()
+        prev = self.prev_block[index]
+        previous = self.block_data[prev] if prev >= 0 else np.zeros(LINE_SIZE, dtype=np.uint8)
+        return int(self.block_address[index]), previous, self.block_data[index]
+
+    def memory_at(self, index):
+        """Reconstruct every line touched up to block index: sorted line addresses and their (n, 64) contents."""
+        self.build_snapshots()
+        lines, writers = self.snapshots.writers_at(index)
+        return lines, self.block_data[writers]
+
+    def export_image(self, index, path, base=0):
+        """Write memory as of block index as a raw image plus JSON region map, see memory_image.write_image."""
+        lines, data = self.memory_at(index)
+        return write_image(path, lines, data, index, base)
+
+    def current_value(self, address):
+        """Value of address after the last writeback, or None if it was never written."""
+        found = self.find_line(address)
+        if found is None:
+            return None
+        i, offset = found
+        return int(self.block_data[self.index.blocks_at(i)[-1], offset])
 
     def query_address(self, address):
         """Query the current value and get value history of an address."""
-        current_value = self.address_dict.get(address, None)
-        history = self.value_history.get(address, [])
+        current_value = self.current_value(address)
         if current_value is None:
             return f"Address {address} not found."
+        blocks, values = self.address_history(address)
         return {
             "address": address,
             "current_value": current_value,
-            "history": history
+            "history": list(zip(blocks.tolist(), values.tolist()))
         }
 
+    def query_many(self, addresses):
+        """Current value of each address as a uint8 array, 0 where never written, and a mask of the written ones."""
+        addresses = np.asarray(addresses, dtype=np.uint64)
+        line_address, offset = split_address(addresses)
+        pos = np.searchsorted(self.index.lines, line_address)
+        found = pos < len(self.index)
+        found[found] = self.index.lines[pos[found]] == line_address[found]
+
+        last = self.index.blocks[self.index.offsets[pos[found] + 1] - 1]
+        values = np.zeros(len(addresses), dtype=np.uint8)
+        values[found] = self.block_data[last, offset[found]]
+        return values, found
+
+    def query_range(self, start, end, t_from=0, t_to=None):
+        """Values of the addresses in [start, end) after each block in [t_from, t_to) that wrote one of them.
+
+        Returns the addresses, the block indices and an (addresses, blocks) uint8 matrix, bytes
+        not written yet read as 0.
+        """
+        t_to = self.index.num_blocks if t_to is None else min(t_to, self.index.num_blocks)
+        first = int(np.searchsorted(self.index.lines, split_address(start)[0]))
+        last = max(first, int(np.searchsorted(self.index.lines, end)))
+
+        # Lines in range are contiguous in the index, so are all their writebacks
+        blocks = self.index.blocks[self.index.offsets[first]:self.index.offsets[last]]
+        times = np.unique(blocks[(blocks >= t_from) & (blocks < t_to)])
+        writers = self.index.writers_between(first, last, times)
+
+        values = self.block_data[np.maximum(writers, 0)]
+        values[writers < 0] = 0
+        values = values.transpose(0, 2, 1).reshape((last - first) * LINE_SIZE, len(times))
+        addresses = (self.index.lines[first:last, None] + _LINE_OFFSETS).reshape(-1)
+        in_range = (addresses >= start) & (addresses < end)
+        return addresses[in_range], times, values[in_range]
+
     def print_addresses(self):
-        """Return all available addresses as a list."""
-        return sorted(self.address_dict.keys())
+        """Return all available addresses as a sorted array."""
+        return (self.index.lines[:, None] + _LINE_OFFSETS).reshape(-1)
+
+    def num_addresses(self):
+        """Number of distinct byte addresses, every touched line contributes all of its bytes."""
+        return len(self.index) * LINE_SIZE
+
+    def addresses(self, start, stop):
+        """Byte addresses at positions [start, stop) of the sorted address list, without building it."""
+        position = np.arange(start, stop, dtype=np.uint64)
+        return self.index.lines[position // LINE_SIZE] + position % LINE_SIZE
+
+    def address_position(self, address):
+        """Position of the first address at or after address in the sorted address list."""
+        line_address, offset = split_address(address)
+        i = int(np.searchsorted(self.index.lines, line_address))
+        if i < len(self.index) and self.index.lines[i] == line_address:
+            return i * LINE_SIZE + offset
+        return i * LINE_SIZE
+
+    def refresh(self):
+        """Index the whole blocks appended to the loaded trace since it was mapped, returns how many."""
+        trace = TraceReader(self.trace.file_path)
+        added = len(trace) - self.index.num_blocks
+        if added <= 0:
+            trace.close()
+            return 0
+
+        self.index = self.index.extend(trace[self.index.num_blocks:]['address'].copy())
+        self.trace, old_trace = trace, self.trace
+        blocks = trace[:self.index.num_blocks]
+        self.block_address = blocks['address']
+        self.block_data = blocks['data']
+        old_trace.close()
+        self.prev_block = None
+        return added
+
+    def append_blocks(self, batch):
+        """Add a BlockBatch received from a stream, its blocks are kept in memory."""
+        self.index = self.index.extend(batch.address)
+        num_blocks = len(self.block_address)
+        stop = num_blocks + len(batch.address)
+        if self._buffer_address is None or stop > len(self._buffer_address):
+            # Double the capacity, so every block is copied a constant number of times on average
+            capacity = max(stop, 2 * num_blocks, 2**16)
+            self._buffer_address = np.empty(capacity, dtype=np.uint64)
+            self._buffer_address[:num_blocks] = self.block_address
+            self._buffer_data = np.empty((capacity, LINE_SIZE), dtype=np.uint8)
+            self._buffer_data[:num_blocks] = self.block_data
+        self._buffer_address[num_blocks:stop] = batch.address
+        self._buffer_data[num_blocks:stop] = batch.data
+        # Views of the filled prefix
+        self.block_address = self._buffer_address[:stop]
+        self.block_data = self._buffer_data[:stop]
+        self.prev_block = None
+
+    def follow(self, file_path, poll_interval=0.5, idle_timeout=None):
+        """Keep up with a trace or named pipe gem5 is still writing, yields the number of blocks each update added.
+
+        Stops after idle_timeout seconds without new blocks, or never when idle_timeout is None.
+        """
+        if stat.S_ISFIFO(os.stat(file_path).st_mode):
+            # A pipe cannot be mapped, its blocks are collected in memory
+            self.close()
+            self.index = LineIndex()
+            for batch in follow_block_batches(file_path, 2**16, 0, 0, poll_interval, idle_timeout):
+                self.append_blocks(batch)
+                yield len(batch.address)
+            return
+
+        if self.trace is None or self.trace.file_path != file_path:
+            self.load_data_from_file(file_path)
+            if self.index.num_blocks:
+                yield self.index.num_blocks
+        idle_since = time.monotonic()
+        while True:
+            added = self.refresh()
+            if added:
+                idle_since = time.monotonic()
+                yield added
+            elif idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+
+    def close(self):
+        """Drop the loaded trace."""
+        self._buffer_address = self._buffer_data = None
+        self.block_address = np.empty(0, dtype=np.uint64)
+        self.block_data = np.empty((0, LINE_SIZE), dtype=np.uint8)
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
 
 
 class AddressManagerGUI:
-    def __init__(self, master, address_manager):
+    ROWS = 20           # Address rows materialized at any time
+    HISTORY_PAGE = 100  # History rows shown per page
+
+    def __init__(self, master, address_manager, follow_interval=None):
         self.master = master
         self.address_manager = address_manager
+        self.follow_interval = follow_interval  # Milliseconds between checks for new blocks, None to not follow
+
+        # Positions [view_lo, view_hi) of the sorted address list are browsable, top is the first row shown
+        self.view_lo = self.view_hi = self.top = 0
+        self.history = None  # (block indices, values) of the selected address
+        self.history_page = 0
+        self.loader = None
+        self.load_error = None
 
         # GUI Layout
         master.title("Address Manager")
 
-        # Address Listbox
+        # Address search: a value jumps to the first address at or after it, start-end restricts the list
+        self.search_label = tk.Label(master, text="Go to address or range (start-end):")
+        self.search_label.pack()
+
+        self.search_entry = tk.Entry(master)
+        self.search_entry.pack()
+        self.search_entry.bind("<Return>", self.search)
+
+        # Address Listbox, only the visible rows are ever inserted
         self.address_list_label = tk.Label(master, text="Available Addresses:")
         self.address_list_label.pack()
 
-        self.address_listbox = tk.Listbox(master)
-        self.address_listbox.pack()
-        self.populate_address_listbox()
+        self.address_frame = tk.Frame(master)
+        self.address_frame.pack()
+        self.address_listbox = tk.Listbox(self.address_frame, height=self.ROWS)
+        self.address_scrollbar = tk.Scrollbar(self.address_frame, command=self.scroll_addresses)
+        self.address_listbox.pack(side=tk.LEFT)
+        self.address_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.address_listbox.bind("<MouseWheel>", self.on_mousewheel)
+        self.address_listbox.bind("<Button-4>", self.on_mousewheel)
+        self.address_listbox.bind("<Button-5>", self.on_mousewheel)
 
         # Select Button
         self.select_button = tk.Button(master, text="Select Address", command=self.select_address)
@@ -101,51 +309,154 @@ class AddressManagerGUI:
         self.result_text = tk.Text(master, height=4, width=50)
         self.result_text.pack()
 
-        # Value History Listbox
+        # Value History Listbox, one page at a time
         self.value_history_label = tk.Label(master, text="Value History with Timestamps:")
         self.value_history_label.pack()
 
-        self.value_history_listbox = tk.Listbox(master)
+        self.value_history_listbox = tk.Listbox(master, height=self.ROWS)
         self.value_history_listbox.pack()
 
+        self.history_frame = tk.Frame(master)
+        self.history_frame.pack()
+        self.prev_page_button = tk.Button(self.history_frame, text="<", command=lambda: self.show_history_page(-1))
+        self.history_page_label = tk.Label(self.history_frame, text="")
+        self.next_page_button = tk.Button(self.history_frame, text=">", command=lambda: self.show_history_page(1))
+        self.prev_page_button.pack(side=tk.LEFT)
+        self.history_page_label.pack(side=tk.LEFT)
+        self.next_page_button.pack(side=tk.LEFT)
+
+        self.status_label = tk.Label(master, text="")
+        self.status_label.pack()
+
+    def load_in_background(self, file_path):
+        """Load the trace on a worker thread so the window stays responsive."""
+        self.status_label.config(text=f"Loading {file_path}...")
+        self.loader = threading.Thread(target=self._load, args=(file_path,), daemon=True)
+        self.loader.start()
+        self.master.after(100, self.poll_loader)
+
+    def _load(self, file_path):
+        try:
+            self.address_manager.load_data_from_file(file_path)
+        except Exception as e:
+            self.load_error = e
+
+    def poll_loader(self):
+        """Tk is not thread safe, the main loop checks on the loader instead of being called back."""
+        if self.loader.is_alive():
+            self.master.after(100, self.poll_loader)
+        elif self.load_error is not None:
+            self.status_label.config(text="")
+            messagebox.showerror("Error", f"Failed to load trace: {self.load_error}")
+        else:
+            self.status_label.config(text=f"{self.address_manager.num_addresses()} addresses")
+            self.populate_address_listbox()
+            if self.follow_interval:
+                self.master.after(self.follow_interval, self.poll_trace)
+
+    def poll_trace(self):
+        """Pick up blocks the simulation appended since the last check."""
+        num_addresses = self.address_manager.num_addresses()
+        if self.address_manager.refresh():
+            if (self.view_lo, self.view_hi) == (0, num_addresses):
+                self.view_hi = self.address_manager.num_addresses()
+            self.render_addresses(self.top)
+            self.status_label.config(text=f"{self.address_manager.num_addresses()} addresses "
+                                          f"({self.address_manager.index.num_blocks} blocks)")
+        self.master.after(self.follow_interval, self.poll_trace)
+
     def populate_address_listbox(self):
-        """Populate the listbox with available addresses."""
-        addresses = self.address_manager.print_addresses()
-        for address in addresses:
+        """Browse the whole sorted address list from the start."""
+        self.view_lo, self.view_hi = 0, self.address_manager.num_addresses()
+        self.render_addresses(0)
+
+    def render_addresses(self, top):
+        """Materialize the rows starting at position top of the browsable range."""
+        self.top = max(self.view_lo, min(top, self.view_hi - self.ROWS))
+        stop = min(self.top + self.ROWS, self.view_hi)
+        self.address_listbox.delete(0, tk.END)
+        for address in self.address_manager.addresses(self.top, stop).tolist():
             self.address_listbox.insert(tk.END, address)
 
+        size = max(1, self.view_hi - self.view_lo)
+        self.address_scrollbar.set((self.top - self.view_lo) / size, (stop - self.view_lo) / size)
+
+    def scroll_addresses(self, *args):
+        """Scrollbar command: ("moveto", fraction) or ("scroll", count, "units" or "pages")."""
+        if args[0] == "moveto":
+            top = self.view_lo + int(float(args[1]) * (self.view_hi - self.view_lo))
+        else:
+            top = self.top + int(args[1]) * (self.ROWS if args[2] == "pages" else 1)
+        self.render_addresses(top)
+
+    def on_mousewheel(self, event):
+        step = -3 if event.num == 4 or event.delta > 0 else 3
+        self.render_addresses(self.top + step)
+        return "break"
+
+    def search(self, event=None):
+        """Jump to an address, or restrict the list to an inclusive start-end range."""
+        text = self.search_entry.get().strip()
+        try:
+            if not text:
+                self.populate_address_listbox()
+            elif "-" in text:
+                start, end = (parse_address(part.strip()) for part in text.split("-", 1))
+                self.view_lo = self.address_manager.address_position(start)
+                self.view_hi = max(self.view_lo, self.address_manager.address_position(end + 1))
+                self.render_addresses(self.view_lo)
+            else:
+                self.view_lo, self.view_hi = 0, self.address_manager.num_addresses()
+                self.render_addresses(self.address_manager.address_position(parse_address(text)))
+        except ValueError:
+            messagebox.showerror("Error", "Invalid address format.")
+
     def select_address(self):
         """Select an address from the listbox, query it, and display its history."""
         try:
             selected_address = int(self.address_listbox.get(self.address_listbox.curselection()))
-            result = self.address_manager.query_address(selected_address)
-            if isinstance(result, dict):
+            current_value = self.address_manager.current_value(selected_address)
+            if current_value is not None:
                 # Display current value in result_text
                 self.result_text.delete(1.0, tk.END)
-                self.result_text.insert(tk.END, f"Address: {result['address']}\n")
-                self.result_text.insert(tk.END, f"Current Value: {result['current_value']}\n")
-                
-                # Populate the value history listbox
-                self.value_history_listbox.delete(0, tk.END)  # Clear previous history
-                for timestamp, value in result["history"]:
-                    self.value_history_listbox.insert(tk.END, f"{timestamp}: {value}")
+                self.result_text.insert(tk.END, f"Address: {selected_address}\n")
+                self.result_text.insert(tk.END, f"Current Value: {current_value}\n")
+
+                # Page through the value history instead of inserting all of it
+                self.history = self.address_manager.address_history(selected_address)
+                self.history_page = 0
+                self.show_history_page(0)
 
             else:
-                messagebox.showinfo("Info", result)
+                messagebox.showinfo("Info", f"Address {selected_address} not found.")
         except IndexError:
             messagebox.showerror("Error", "Please select an address.")
         except ValueError:
             messagebox.showerror("Error", "Invalid address format.")
 
+    def show_history_page(self, step):
+        """Move step pages through the history of the selected address and display that page."""
+        if self.history is None:
+            return
+        blocks, values = self.history
+        last_page = max(0, (len(blocks) - 1) // self.HISTORY_PAGE)
+        self.history_page = max(0, min(self.history_page + step, last_page))
+        start = self.history_page * self.HISTORY_PAGE
+        stop = min(start + self.HISTORY_PAGE, len(blocks))
+
+        self.value_history_listbox.delete(0, tk.END)  # Clear previous history
+        for timestamp, value in zip(blocks[start:stop].tolist(), values[start:stop].tolist()):
+            self.value_history_listbox.insert(tk.END, f"{timestamp}: {value}")
+        self.history_page_label.config(text=f"{start + 1 if stop else 0}-{stop} of {len(blocks)}")
 
-# Run the application
-file_path = 'data.log'
 
-# Load data and create AddressManager instance
-address_manager = AddressManager()
-address_manager.load_data_from_file(file_path)
+# Run the application
+if __name__ == "__main__":
+    file_path = 'data.log'
 
-# Set up the GUI
-root = tk.Tk()
-app = AddressManagerGUI(root, address_manager)
-root.mainloop()
+    # The window comes up right away, the trace is loaded in the background
+    address_manager = AddressManager()
+    root = tk.Tk()
+    app = AddressManagerGUI(root, address_manager)
+    app.load_in_background(file_path)
+    root.mainloop()
@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from trace_reader import TraceReader
+
+# Sidecar index file written next to a trace: a fixed header followed by the
+# lines, offsets and blocks arrays of a LineIndex, all little-endian 64-bit
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'GEMLIDX\x00'
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct('<8sIIQQI')  # magic, version, reserved, blocks, lines, fingerprint
+INDEX_HEADER_SIZE = 64
+FINGERPRINT_BYTES = 2**16
+
+
+class LineIndex:
+    """Compressed sparse map from each distinct line address to the block indices that wrote it back."""
+
+    def __init__(self, lines=None, offsets=None, blocks=None):
+        # blocks[offsets[i]:offsets[i + 1]] are the block indices of lines[i], in ascending order
+        self.lines = np.empty(0, dtype=np.uint64) if lines is None else lines
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self.blocks = np.empty(0, dtype=np.int64) if blocks is None else blocks
+        # CRC32 of the head and tail of the indexed trace bytes, see open_index
+        self.fingerprint = 0
+
+    @classmethod
+    def build(cls, block_address):
+        """Index the line address of every block in one sort."""
+        blocks = np.argsort(block_address, kind='stable').astype(np.int64, copy=False)
+        return cls._from_sorted(block_address[blocks], blocks)
+
+    @classmethod
+    def _from_sorted(cls, sorted_lines, blocks):
+        first = np.ones(len(blocks), dtype=bool)
+        first[1:] = sorted_lines[1:] != sorted_lines[:-1]
+        offsets = np.append(np.flatnonzero(first), len(blocks)).astype(np.int64, copy=False)
+        return cls(sorted_lines[first], offsets, blocks)
+
+    def extend(self, block_address):
+        """New index that also covers blocks appended after the num_blocks already indexed."""
+        tail = LineIndex.build(block_address)
+        tail_counts = tail.write_counts()
+        pos = np.searchsorted(self.lines, tail.lines)
+        present = pos < len(self.lines)
+        present[present] = self.lines[pos[present]] == tail.lines[present]
+
+        # New blocks come after every indexed one, so they go at the end of their line's run and
+        # merge in one linear pass instead of a sort over all blocks
+        at = np.where(present, self.offsets[np.minimum(pos + 1, len(self.lines))], self.offsets[pos])
+        blocks = np.insert(self.blocks, np.repeat(at, tail_counts), tail.blocks + self.num_blocks)
+        lines = np.insert(self.lines, pos[~present], tail.lines[~present])
+        counts = np.insert(self.write_counts(), pos[~present], 0)
+        counts[np.searchsorted(lines, tail.lines)] += tail_counts
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return LineIndex(lines, offsets, blocks)
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def num_blocks(self):
+        return len(self.blocks)
+
+    def find(self, line_address):
+        """Position of line_address in self.lines, or -1 if it was never written back."""
+        i = int(np.searchsorted(self.lines, line_address))
+        if i == len(self.lines) or self.lines[i] != line_address:
+            return -1
+        return i
+
+    def blocks_at(self, i):
+        """Block indices of lines[i], in time order."""
+        return self.blocks[self.offsets[i]:self.offsets[i + 1]]
+
+    def writers_between(self, first, last, times):
+        """Last block at or before each of times that wrote lines[first:last], as a matrix, -1 where none."""
+        times = np.asarray(times, dtype=np.int64)
+        writers = np.full((last - first, len(times)), -1, dtype=np.int64)
+        if last <= first:
+            return writers
+        lo, hi = self.offsets[first], self.offsets[last]
+        blocks = self.blocks[lo:hi]
+
+        # Offset every line's block indices into its own key range so one search covers all lines
+        span = self.num_blocks + 1
+        rows = np.arange(last - first, dtype=np.int64)
+        keys = np.repeat(rows, np.diff(self.offsets[first:last + 1])) * span + blocks
+        pos = np.searchsorted(keys, rows[:, None] * span + times, side='right') - 1
+        written = pos >= (self.offsets[first:last] - lo)[:, None]
+        writers[written] = blocks[pos[written]]
+        return writers
+
+    def write_counts(self):
+        """Number of writebacks of every line in self.lines."""
+        return np.diff(self.offsets)
+
+    def prev_blocks(self):
+        """For every block, the previous block that wrote back the same line, -1 for a line's first write."""
+        prev_sorted = np.empty(len(self.blocks), dtype=np.int64)
+        prev_sorted[1:] = self.blocks[:-1]
+        prev_sorted[self.offsets[:-1]] = -1
+        prev = np.empty(len(self.blocks), dtype=np.int64)
+        prev[self.blocks] = prev_sorted
+        return prev
+
+
+def trace_fingerprint(trace, num_blocks):
+    """Cheap CRC32 of the first and last bytes of blocks [0, num_blocks), to spot a rewritten trace."""
+    data = trace[:num_blocks].view(np.uint8)
+    return zlib.crc32(data[-FINGERPRINT_BYTES:], zlib.crc32(data[:FINGERPRINT_BYTES]))
+
+
+def read_index(path):
+    """Memory-map a sidecar index file, or return None when it is missing, truncated or another version."""
+    if not os.path.exists(path) or os.path.getsize(path) < INDEX_HEADER_SIZE:
+        return None
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, _, num_blocks, num_lines, fingerprint = INDEX_HEADER.unpack_from(mm)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or len(mm) != INDEX_HEADER_SIZE + 8 * (2 * num_lines + 1 + num_blocks):
+        return None
+    offset = INDEX_HEADER_SIZE
+    lines = np.frombuffer(mm, dtype='<u8', count=num_lines, offset=offset)
+    offset += lines.nbytes
+    offsets = np.frombuffer(mm, dtype='<i8', count=num_lines + 1, offset=offset)
+    offset += offsets.nbytes
+    blocks = np.frombuffer(mm, dtype='<i8', count=num_blocks, offset=offset)
+
+    index = LineIndex(lines, offsets, blocks)
+    index.fingerprint = fingerprint
+    return index
+
+
+def write_index(index, path):
+    """Write a LineIndex to a sidecar file, replacing any previous one atomically."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, index.num_blocks, len(index.lines),
+                                   index.fingerprint)
+        fp.write(header.ljust(INDEX_HEADER_SIZE, b'\x00'))
+        for array, dtype in ((index.lines, '<u8'), (index.offsets, '<i8'), (index.blocks, '<i8')):
+            np.ascontiguousarray(array, dtype=dtype).tofile(fp)
+    os.replace(tmp_path, path)
+
+
+def open_index(file_path, path=None):
+    """LineIndex of a whole trace from its sidecar file, built or extended first when stale."""
+    path = path or file_path + INDEX_SUFFIX
+    with TraceReader(file_path) as trace:
+        num_blocks = len(trace)
+        index = read_index(path)
+        if index is not None and (index.num_blocks > num_blocks
+                                  or index.fingerprint != trace_fingerprint(trace, index.num_blocks)):
+            # The trace was truncated or rewritten, not appended to
+            index = None
+        if index is not None and index.num_blocks == num_blocks:
+            return index
+
+        # Only the blocks appended since the sidecar was written need indexing
+        if index is None:
+            index = LineIndex()
+        start = index.num_blocks
+        index = index.extend(trace[start:num_blocks]['address'].copy())
+        index.fingerprint = trace_fingerprint(trace, num_blocks)
+
+    try:
+        write_index(index, path)
+    except OSError:
+        # A read-only trace directory only costs the rebuild on the next start
+        pass
+    return index
@@ -0,0 +1,196 @@
+import os
+import stat
+from collections import namedtuple
+import numpy as np
+
+from trace_reader import (LINE_SIZE, TraceReader, iter_batches, iter_block_batches, follow_batches,
+                          follow_block_batches)
+
+# Per-byte rows that changed in the blocks [start, stop), with the value each byte had before
+DeltaBatch = namedtuple('DeltaBatch', ['address', 'prev', 'value', 'timestamp', 'start', 'stop'])
+
+
+class LineState:
+    """Last known contents of every line seen so far, kept as a sorted columnar table."""
+
+    def __init__(self, keep_first_write=True):
+        # keep_first_write emits all 64 bytes of a line's first writeback, otherwise
+        # the first writeback is compared against zero-filled memory like any other
+        self.keep_first_write = keep_first_write
+        self.lines = np.empty(0, dtype=np.uint64)
+        self.data = np.empty((0, LINE_SIZE), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def locate(self, addresses):
+        """Row of each line address in the table and whether the line is known at all."""
+        pos = np.searchsorted(self.lines, addresses)
+        if not len(self.lines):
+            return pos, np.zeros(len(addresses), dtype=bool)
+        known = self.lines[np.minimum(pos, len(self.lines) - 1)] == addresses
+        return pos, known
+
+    def store(self, addresses, data):
+        """Overwrite the state of distinct, sorted line addresses with data."""
+        pos, known = self.locate(addresses)
+        self.data[pos[known]] = data[known]
+        if not known.all():
+            new = ~known
+            self.lines = np.insert(self.lines, pos[new], addresses[new])
+            self.data = np.insert(self.data, pos[new], data[new], axis=0)
+
+    def prime(self, trace, stop, chunk_blocks=2**20):
+        """Load the state as of block stop from a TraceReader without emitting anything."""
+        for first in range(0, stop, chunk_blocks):
+            blocks = trace[first:min(first + chunk_blocks, stop)]
+            # Only the last writeback of each line in the chunk matters
+            lines, last = np.unique(blocks['address'][::-1], return_index=True)
+            self.store(lines, blocks['data'][len(blocks) - 1 - last])
+
+    def apply(self, batch):
+        """Advance the state by a BlockBatch and return a DeltaBatch of the bytes it changed."""
+        count = len(batch.address)
+
+        # Group the writebacks of each line together, in time order within the line
+        order = np.lexsort((np.arange(count), batch.address))
+        lines = batch.address[order]
+        data = batch.data[order]
+        first_of_line = np.ones(count, dtype=bool)
+        first_of_line[1:] = lines[1:] != lines[:-1]
+        last_of_line = np.ones(count, dtype=bool)
+        last_of_line[:-1] = first_of_line[1:]
+
+        # Previous contents: the line's earlier writeback in this batch, else the state table
+        pos, known = self.locate(lines)
+        prev = np.empty_like(data)
+        prev[1:] = data[:-1]
+        from_table = first_of_line & known
+        prev[from_table] = self.data[pos[from_table]]
+        prev[first_of_line & ~known] = 0
+
+        changed = data != prev
+        if self.keep_first_write:
+            changed[first_of_line & ~known] = True
+        self.store(lines[last_of_line], data[last_of_line])
+
+        # Emit the changed bytes in trace order
+        rows, offsets = np.nonzero(changed)
+        block = order[rows]
+        emit = np.lexsort((offsets, block))
+        rows, offsets, block = rows[emit], offsets[emit], block[emit]
+        return DeltaBatch(lines[rows] + offsets.astype(np.uint64), prev[rows, offsets], data[rows, offsets],
+                          batch.timestamp[block], batch.start, batch.stop)
+
+
+class SnapshotIndex:
+    """Which block last wrote every line, saved every interval blocks, for time travel over a trace."""
+
+    def __init__(self, interval=2**20):
+        self.interval = max(1, interval)
+        self.num_blocks = 0
+        # Snapshot k holds the state after blocks [0, k * interval), the last one the end of the trace
+        self.lines = []
+        self.writers = []
+        self.block_address = np.empty(0, dtype=np.uint64)
+        self.prev_block = np.empty(0, dtype=np.int64)
+
+    def build(self, block_address, prev_block):
+        """Take snapshots in one pass over the line address of every block and its undo link."""
+        self.block_address = block_address
+        self.prev_block = prev_block
+        self.num_blocks = len(block_address)
+
+        lines = np.empty(0, dtype=np.uint64)
+        writers = np.empty(0, dtype=np.int64)
+        self.lines, self.writers = [lines], [writers]
+        for first in range(0, self.num_blocks, self.interval):
+            chunk = block_address[first:first + self.interval]
+            # Only the last writeback of each line in the chunk matters
+            chunk_lines, last = np.unique(chunk[::-1], return_index=True)
+            chunk_writers = first + len(chunk) - 1 - last.astype(np.int64)
+
+            pos = np.searchsorted(lines, chunk_lines)
+            known = np.zeros(len(chunk_lines), dtype=bool)
+            if len(lines):
+                known = lines[np.minimum(pos, len(lines) - 1)] == chunk_lines
+            writers = writers.copy()
+            writers[pos[known]] = chunk_writers[known]
+            new = ~known
+            lines = np.insert(lines, pos[new], chunk_lines[new])
+            writers = np.insert(writers, pos[new], chunk_writers[new])
+            self.lines.append(lines)
+            self.writers.append(writers)
+
+    def writers_at(self, index):
+        """Sorted line addresses touched up to and including block index and the block that last wrote each."""
+        if not 0 <= index < self.num_blocks:
+            raise IndexError("block index out of range")
+        boundary = index + 1
+        k = -(-boundary // self.interval)
+        lines, writers = self.lines[k], self.writers[k].copy()
+        stop = min(k * self.interval, self.num_blocks)
+
+        # Undo the blocks [boundary, stop) on top of the next snapshot: the first of them
+        # to write a line links back to the writer the line had at block index
+        window_lines, first = np.unique(self.block_address[boundary:stop], return_index=True)
+        pos = np.searchsorted(lines, window_lines)
+        writers[pos] = self.prev_block[boundary + first]
+        touched = writers >= 0
+        return lines[touched], writers[touched]
+
+
+def iter_delta_batches(file_path, batch_size, start=0, stop=None, timestamp_offset=0, keep_first_write=True):
+    """Yield DeltaBatch rows holding only the bytes each writeback changed in blocks [start, stop)."""
+    state = LineState(keep_first_write)
+    if start:
+        # Resuming mid-trace: rebuild what every line held before start
+        with TraceReader(file_path) as trace:
+            state.prime(trace, min(start, len(trace)))
+
+    blocks_per_batch = max(1, batch_size // LINE_SIZE)
+    for batch in iter_block_batches(file_path, blocks_per_batch, start, stop, timestamp_offset):
+        yield state.apply(batch)
+
+
+def follow_delta_batches(file_path, batch_size, start=0, timestamp_offset=0, keep_first_write=True,
+                         poll_interval=0.5, idle_timeout=None):
+    """Like iter_delta_batches, but keeps following the trace as it grows, see follow_block_batches."""
+    state = LineState(keep_first_write)
+    if start and not stat.S_ISFIFO(os.stat(file_path).st_mode):
+        # A pipe cannot be replayed, its lines start out unknown
+        with TraceReader(file_path) as trace:
+            state.prime(trace, min(start, len(trace)))
+
+    for batch in follow_block_batches(file_path, batch_size // LINE_SIZE, start, timestamp_offset,
+                                      poll_interval, idle_timeout):
+        yield state.apply(batch)
+
+
+def check_delta(delta, blocks):
+    """Reject delta ingestion for a schema that stores whole writebacks."""
+    if delta and blocks:
+        raise ValueError("Delta ingestion stores single bytes, it needs the 'byte' schema")
+
+
+def trace_batches(file_path, batch_size, start=0, stop=None, blocks=False, delta=False, keep_first_write=True,
+                  timestamp_offset=0, follow=False, poll_interval=1.0, idle_timeout=None):
+    """Batches of blocks [start, stop) of a trace shaped for a loader's schema.
+
+    blocks yields a BlockBatch per batch_size writebacks, otherwise per-byte rows: an AddressBatch,
+    or with delta a DeltaBatch of only the bytes each writeback changed (and all bytes of a line's
+    first write with keep_first_write). With follow, stop is ignored and the trace or pipe is read
+    as the simulation appends to it, until idle_timeout seconds pass without new blocks.
+    """
+    if blocks:
+        if follow:
+            return follow_block_batches(file_path, batch_size, start, timestamp_offset, poll_interval, idle_timeout)
+        return iter_block_batches(file_path, batch_size, start, stop, timestamp_offset)
+    if delta:
+        if follow:
+            return follow_delta_batches(file_path, batch_size, start, timestamp_offset, keep_first_write,
+                                        poll_interval, idle_timeout)
+        return iter_delta_batches(file_path, batch_size, start, stop, timestamp_offset, keep_first_write)
+    if follow:
+        return follow_batches(file_path, batch_size, start, timestamp_offset, poll_interval, idle_timeout)
+    return iter_batches(file_path, batch_size, start, stop, timestamp_offset)
@@ -1,21 +1,72 @@
 from tqdm import tqdm
 import psycopg2
-from psycopg2 import extras
-from array import array
 import os
 
+from trace_reader import BLOCK_SIZE, LINE_SIZE
+from pg_ingest import (INSERT_MODES, ID_MODES, SCHEMAS, PARTITION_MODES, PARTITION_KEYS, AddressIdCache,
+                       write_batch, write_block_batch, create_block_tables, create_block_index, create_unique_keys,
+                       partition_clause, adopt_partitioning, range_partitions, create_range_partitions,
+                       create_progress_table, progress_target, fetch_progress, register_ranges, plan_progress,
+                       advance_progress, EXPORT_FORMATS, iter_row_chunks, copy_query_to, export_numpy_chunks)
+from line_state import trace_batches, check_delta
+
 class BinaryFileParser:
-    def __init__(self, db_params, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt'):
+    def __init__(self, db_params, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt',
+                 insert_mode='copy', id_mode='lookup', address_cache_size=2**18, schema='byte',
+                 delta=False, keep_first_write=True, idempotent=False, partition='none', partition_blocks=2**20,
+                 num_partitions=16):
+        if schema not in SCHEMAS:
+            raise ValueError(f"Unknown schema {schema!r}, expected one of {SCHEMAS}")
+        check_delta(delta, schema == 'block')
+        if insert_mode not in INSERT_MODES:
+            raise ValueError(f"Unknown insert mode {insert_mode!r}, expected one of {INSERT_MODES}")
+        if id_mode not in ID_MODES:
+            raise ValueError(f"Unknown id mode {id_mode!r}, expected one of {ID_MODES}")
+        if partition not in PARTITION_MODES:
+            raise ValueError(f"Unknown partition mode {partition!r}, expected one of {PARTITION_MODES}")
         self.db_params = db_params
+        self.insert_mode = insert_mode  # 'copy' (binary COPY), 'staging' (COPY + merge) or 'values'
+        self.id_mode = id_mode  # 'lookup' (BIGSERIAL ids) or 'derived' (id = address)
+        self.address_cache_size = address_cache_size  # 0 disables the address -> id cache
+        self.schema = schema  # 'byte' (AddressData row per byte) or 'block' (AddressBlocks row per writeback)
+        self.delta = delta  # Per-byte rows only hold changed bytes, see line_state.trace_batches
+        self.keep_first_write = keep_first_write
+        self.idempotent = idempotent  # Unique (address, timestamp) key, replayed batches insert nothing
+        # 'none', 'range' (partition_blocks timestamps per partition) or 'hash' (num_partitions on the address),
+        # only applies when the data table is created
+        self.partition = partition
+        self.partition_blocks = partition_blocks
+        self.num_partitions = num_partitions
+        self.partitions = set()  # Range partitions known to exist
+        self.data_table = 'AddressBlocks' if schema == 'block' else 'AddressData'
+        self.target = progress_target(schema, delta)  # Keeps checkpoints of different loads of a trace apart
         self.batch_size = batch_size
         self.NUM_BLOCK_PROCESS = num_block_process
         self.checkpoint_file = checkpoint_file
+        self.address_cache = AddressIdCache(address_cache_size) if address_cache_size else None
         self.conn = psycopg2.connect(**db_params)
         self.create_tables()
 
+    def iter_trace(self, file_path, start=0, stop=None, follow=False, poll_interval=1.0, idle_timeout=None):
+        """Batches of blocks [start, stop) shaped for the configured schema, the block index is the timestamp."""
+        return trace_batches(file_path, self.batch_size, start, stop, self.schema == 'block', self.delta,
+                             self.keep_first_write, 0, follow, poll_interval, idle_timeout)
+
     def create_tables(self):
         """Create normalized tables if they don't exist in PostgreSQL."""
         with self.conn.cursor() as cur:
+            # Checkpoints live in the database so they commit atomically with the data
+            create_progress_table(cur)
+
+            if self.schema == 'block':
+                create_block_tables(cur, self.partition)
+                self.partition = adopt_partitioning(cur, self.data_table, self.partition, self.num_partitions)
+                create_block_index(cur)
+                if self.idempotent:
+                    create_unique_keys(cur, self.schema)
+                self.conn.commit()
+                return
+
             # Create the Addresses table to store unique addresses
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS Addresses (
@@ -24,134 +75,164 @@ class BinaryFileParser:
                 )
             """)
             
-            # Create the AddressData table to store data and timestamps, linked to Addresses table
-            cur.execute("""
+            # Create the AddressData table to store data and timestamps, linked to Addresses table.
+            # The primary key of a partitioned table has to include its partition key.
+            primary_key = "id" if self.partition == 'none' else f"id, {PARTITION_KEYS['AddressData'][self.partition]}"
+            cur.execute(f"""
                 CREATE TABLE IF NOT EXISTS AddressData (
-                    id BIGSERIAL PRIMARY KEY,
+                    id BIGSERIAL,
                     address_id BIGINT REFERENCES Addresses(id),
                     data SMALLINT,
-                    timestamp BIGINT
-                )
+                    timestamp BIGINT,
+                    PRIMARY KEY ({primary_key})
+                ) {partition_clause('AddressData', self.partition)}
             """)
+            self.partition = adopt_partitioning(cur, self.data_table, self.partition, self.num_partitions)
             
             # Create index on address_id for faster lookups
             # cur.execute("CREATE INDEX IF NOT EXISTS idx_address_id ON AddressData (address_id);")
+            if self.idempotent:
+                create_unique_keys(cur, self.schema)
             self.conn.commit()
 
-    def get_checkpoint(self):
-        """Retrieve the last processed block index from the checkpoint file."""
-        if os.path.exists(self.checkpoint_file):
-            with open(self.checkpoint_file, 'r') as f:
-                return int(f.read().strip())
-        return 0
-
-    def update_checkpoint(self, last_processed_index):
-        """Update the checkpoint file with the last processed block index."""
-        with open(self.checkpoint_file, 'w') as f:
-            f.write(str(last_processed_index))
-
-    def parse_binary_file(self, fp):
-        """Read and parse a 72-byte block from the binary file to extract address and data."""
-        data = fp.read(8)
-        if len(data) != 8:
-            raise ValueError("Invalid data size. Expected 8 bytes for address.")
-        address = int.from_bytes(data, byteorder='little')
-
-        # data = array('B')
-        # for _ in range(64):
-        #     d = fp.read(1)
-        #     if not d:
-        #         break
-        #     data.append(d[0])
-        # return [(address + i, data[i]) for i in range(64)]
-
-        data = array('B', fp.read(64))
-        length = len(data)
-        return [(address + i, data[i]) for i in range(length)]
-
-    def load_data_from_file(self, file_path):
-        """Load and process blocks from a binary file and store address values in PostgreSQL."""
-        last_processed_index = self.get_checkpoint()
-        with open(file_path, 'rb') as fp:
-            file_size = os.path.getsize(file_path)
-            num_blocks = min(file_size // 72, self.NUM_BLOCK_PROCESS)
-
-            # Move the file pointer to the last processed block
-            fp.seek(last_processed_index * 72)
-
-            with tqdm(total=num_blocks, desc="Inserting Blocks into Database", initial=last_processed_index) as pbar:
-                batch_data = []
-                try:
-                    index = last_processed_index
-                    timestamp = index
-                    while index < num_blocks:
-                        data_value = self.parse_binary_file(fp)
-                        # Collect address and data together for bulk insertion
-                        batch_data.extend([(address, data, timestamp) for address, data in data_value])
-
-                        if len(batch_data) >= self.batch_size:
-                            self.insert_batch(batch_data)
-                            batch_data.clear()
-                            
-                            # Update the checkpoint after processing each batch
-                            self.update_checkpoint(index + 1)
-
-                        pbar.update(1)
-                        index += 1
-                        timestamp += 1
-
-                    if batch_data:
-                        self.insert_batch(batch_data)
-                        self.update_checkpoint(index)
-                except Exception as e:
-                    print(f"Error or End of File: {e}")
-
-
-
-    def insert_batch(self, batch_data):
-        """Perform a batch insert of addresses and data into the PostgreSQL database."""
-        with self.conn.cursor() as cur:
-            # Step 1: Insert addresses directly with ON CONFLICT DO NOTHING
-            address_only = [(address,) for address, _, _ in batch_data]
-            insert_addresses_query = """
-                INSERT INTO Addresses (address) VALUES %s
-                ON CONFLICT DO NOTHING
-            """
-            extras.execute_values(cur, insert_addresses_query, address_only)
-
-            # Step 2: Join Addresses with inserted data for AddressData insertion
-            cur.execute("SELECT id, address FROM Addresses WHERE address = ANY(%s);", 
-                        (list(set([address for address, _, _ in batch_data])),))
-            address_id_map = {address: address_id for address_id, address in cur.fetchall()}
-
-            # Prepare data for AddressData
-            address_data_batch = [(address_id_map[address], data, timestamp) 
-                                  for address, data, timestamp in batch_data 
-                                  if address in address_id_map]
-            
-            insert_data_query = """
-                INSERT INTO AddressData (address_id, data, timestamp)
-                VALUES %s
-            """
-            extras.execute_values(cur, insert_data_query, address_data_batch)
-            self.conn.commit()
-
+    def plan_ranges(self, trace, num_blocks):
+        """Return the unfinished (range_start, range_end, next_block) ranges of a load of blocks [0, num_blocks).
 
-    def fetch_all_data(self):
-        """Fetch all data entries from PostgreSQL and display progress with tqdm."""
+        Ranges left by a parallel load of the same trace are finished one after another.
+        """
         with self.conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM AddressData")
-            total_entries = cur.fetchone()[0]
+            if not fetch_progress(cur, trace, self.target) and os.path.exists(self.checkpoint_file):
+                # First load of this trace, an old checkpoint file still tells us where to resume
+                with open(self.checkpoint_file, 'r') as f:
+                    next_block = int(f.read().strip())
+                register_ranges(cur, trace, self.target, [(0, next_block, next_block)])
+            ranges = plan_progress(cur, trace, self.target, num_blocks)
+        self.conn.commit()
+        return ranges
+
+    def load_data_from_file(self, file_path, follow=False, poll_interval=1.0, idle_timeout=None):
+        """Load and process blocks from a binary file and store address values in PostgreSQL.
+
+        With follow, keep loading new blocks while the simulation is still writing the trace, until
+        idle_timeout seconds pass without any (forever when None). NUM_BLOCK_PROCESS is ignored then.
+        """
+        trace = os.path.abspath(file_path)
+        num_blocks = os.path.getsize(file_path) // BLOCK_SIZE
+        if not follow:
+            num_blocks = min(num_blocks, self.NUM_BLOCK_PROCESS)
+        pending = self.plan_ranges(trace, num_blocks)
+        loaded = num_blocks - sum(range_end - next_block for _, range_end, next_block in pending)
+
+        with tqdm(total=None if follow else num_blocks, desc="Inserting Blocks into Database",
+                  initial=loaded) as pbar:
+            try:
+                for range_start, range_end, next_block in pending:
+                    for batch in self.iter_trace(file_path, next_block, range_end):
+                        # The checkpoint is updated in the same transaction as the batch
+                        self.insert_batch(batch, progress=(trace, range_start))
+                        pbar.update(batch.stop - batch.start)
+                if follow:
+                    # Followed blocks go into a range of their own, which grows as they are loaded
+                    with self.conn.cursor() as cur:
+                        register_ranges(cur, trace, self.target, [(num_blocks, num_blocks, num_blocks)])
+                    self.conn.commit()
+                    for batch in self.iter_trace(file_path, num_blocks, None, True, poll_interval, idle_timeout):
+                        self.insert_batch(batch, progress=(trace, num_blocks))
+                        pbar.update(batch.stop - batch.start)
+            except Exception as e:
+                print(f"Error or End of File: {e}")
+
+
+    def create_partitions(self, batch):
+        """Create the range partitions a batch writes to that are not known to exist yet."""
+        needed = range_partitions(batch.timestamp, self.partition_blocks) - self.partitions
+        if not needed:
+            return
+        # In a short transaction of its own, so the lock on the parent is not held while the batch is written
+        try:
+            with self.conn.cursor() as cur:
+                create_range_partitions(cur, self.data_table, needed, self.partition_blocks)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.partitions |= needed
 
+    def insert_batch(self, batch, progress=None):
+        """Perform a batch insert of addresses and data into the PostgreSQL database."""
+        if self.partition == 'range':
+            self.create_partitions(batch)
+        try:
+            with self.conn.cursor() as cur:
+                if self.schema == 'block':
+                    write_block_batch(cur, batch, self.idempotent)
+                else:
+                    write_batch(cur, batch, self.insert_mode, self.address_cache, self.id_mode, self.idempotent)
+                if progress is not None:
+                    trace, range_start = progress
+                    advance_progress(cur, trace, self.target, range_start, batch.stop)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            # Ids cached during this batch may belong to rows that were just rolled back
+            if self.address_cache is not None:
+                self.address_cache.clear()
+            raise
+
+
+    def fetch_all_data(self, path=None, export_format='csv', itersize=2**16):
+        """Stream all data entries from PostgreSQL, printed with tqdm progress or exported to path.
+
+        export_format is one of EXPORT_FORMATS; for 'numpy' path is a format string taking the chunk
+        number and the written paths are returned. Memory use does not grow with the table size.
+        """
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format!r}, expected one of {EXPORT_FORMATS}")
+        if self.schema == 'block':
+            # Every writeback row expands to one row per byte through the view
+            count_query = f"SELECT COUNT(*) * {LINE_SIZE} FROM AddressBlocks"
+            fetch_query = "SELECT address, data, timestamp FROM AddressBlockBytes"
+        else:
+            count_query = "SELECT COUNT(*) FROM AddressData"
+            fetch_query = """
+                SELECT Addresses.address, AddressData.data, AddressData.timestamp 
+                FROM AddressData 
+                JOIN Addresses ON AddressData.address_id = Addresses.id
+            """
+        try:
+            if path is not None and export_format == 'numpy':
+                return export_numpy_chunks(self.conn, fetch_query, path, itersize)
+            if path is not None:
+                with self.conn.cursor() as cur, open(path, 'wb') as fp:
+                    copy_query_to(cur, fetch_query, fp, export_format)
+                return
+
+            with self.conn.cursor() as cur:
+                cur.execute(count_query)
+                total_entries = cur.fetchone()[0]
             with tqdm(total=total_entries, desc="Fetching Records") as pbar:
+                for rows in iter_row_chunks(self.conn, fetch_query, itersize):
+                    for row in rows:
+                        print(row)
+                    pbar.update(len(rows))
+        finally:
+            # End the read transaction the server-side cursor ran in
+            self.conn.rollback()
+
+    def fetch_address_history(self, address):
+        """Return the (data, timestamp) history of one byte address in timestamp order."""
+        with self.conn.cursor() as cur:
+            if self.schema == 'block':
+                cur.execute("SELECT data, timestamp FROM address_history(%s)", (address,))
+            else:
                 cur.execute("""
-                    SELECT Addresses.address, AddressData.data, AddressData.timestamp 
-                    FROM AddressData 
+                    SELECT AddressData.data, AddressData.timestamp
+                    FROM AddressData
                     JOIN Addresses ON AddressData.address_id = Addresses.id
-                """)
-                for row in cur:
-                    print(row)
-                    pbar.update(1)
+                    WHERE Addresses.address = %s
+                    ORDER BY AddressData.timestamp
+                """, (address,))
+            return cur.fetchall()
 
     def close(self):
         """Close the database connection."""
@@ -169,5 +250,5 @@ if __name__ == "__main__":
 
     parser = BinaryFileParser(db_params=db_params, batch_size=2**14, num_block_process=2**60)
     parser.load_data_from_file("../data/data.log")
-    parser.fetch_all_data()
+    parser.fetch_all_data("../data/data.csv")
     parser.close()
@@ -1,11 +1,29 @@
 from tqdm import tqdm
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
 import os
-from array import array
+import numpy as np
+
+from trace_reader import BLOCK_SIZE, split_address
+from line_state import trace_batches, check_delta
+
+SCHEMAS = ('byte', 'block', 'bucket')
+
+DUPLICATE_KEY = 11000  # MongoDB error code of a unique index violation
 
 class BinaryFileParserMongoDB:
-    def __init__(self, db_params, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt'):
+    def __init__(self, db_params, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt',
+                 schema='byte', delta=False, keep_first_write=True, bucket_size=2**12, write_concern=None):
+        if schema not in SCHEMAS:
+            raise ValueError(f"Unknown schema {schema!r}, expected one of {SCHEMAS}")
+        check_delta(delta, schema == 'block')
+        self.delta = delta  # Per-byte rows only hold changed bytes, see line_state.trace_batches
+        self.keep_first_write = keep_first_write
         self.db_params = db_params
+        # 'byte' (document per address), 'block' (document per writeback) or
+        # 'bucket' (document per address and bucket_size consecutive timestamps)
+        self.schema = schema
+        self.bucket_size = bucket_size
         self.batch_size = batch_size
         self.NUM_BLOCK_PROCESS = num_block_process
         self.checkpoint_file = checkpoint_file
@@ -16,11 +34,26 @@ class BinaryFileParserMongoDB:
             password=db_params.get('password'),
             authSource=db_params.get('authSource', 'admin')
         )
-        self.db = self.client[db_params['database']]
+        # write_concern holds WriteConcern options such as {'w': 1, 'j': False}, None keeps the server default
+        self.write_concern = write_concern
+        self.db = self.client.get_database(
+            db_params['database'],
+            write_concern=WriteConcern(**write_concern) if write_concern is not None else None
+        )
         self.collection = self.db["AddressData"]
+        self.block_collection = self.db["AddressBlocks"]
+        self.bucket_collection = self.db["AddressBuckets"]
 
     def create_indexes(self):
         """Create indexes for MongoDB collection."""
+        if self.schema == 'block':
+            # History of a line is a range scan over this index
+            self.block_collection.create_index([("line_address", 1), ("timestamp", 1)])
+            return
+        if self.schema == 'bucket':
+            # Upserts find their bucket through this index, history reads scan it in bucket order
+            self.bucket_collection.create_index([("address", 1), ("bucket", 1)], unique=True)
+            return
         self.collection.create_index("data.timestamp")  # Index for fast queries on timestamps
 
     def get_checkpoint(self):
@@ -35,70 +68,154 @@ class BinaryFileParserMongoDB:
         with open(self.checkpoint_file, 'w') as f:
             f.write(str(last_processed_index))
 
-    def parse_binary_file(self, fp):
-        """Read and parse a 72-byte block from the binary file to extract address and data."""
-        data = fp.read(8)
-        if len(data) != 8:
-            raise ValueError("Invalid data size. Expected 8 bytes for address.")
-        address = int.from_bytes(data, byteorder='little')
+    def iter_trace(self, file_path, start=0, stop=None, follow=False, poll_interval=1.0, idle_timeout=None):
+        """Batches of blocks [start, stop) shaped for the configured schema, see line_state.trace_batches."""
+        # Timestamps are labelled T1, T2, etc. (plain 1, 2, etc. in the block and bucket schemas)
+        return trace_batches(file_path, self.batch_size, start, stop, self.schema == 'block', self.delta,
+                             self.keep_first_write, 1, follow, poll_interval, idle_timeout)
 
-        data = array('B', fp.read(64))
-        length = len(data)
-        return [(address + i, data[i]) for i in range(length)]
+    def load_data_from_file(self, file_path, follow=False, poll_interval=1.0, idle_timeout=None):
+        """Load and process blocks from a binary file and store address values in MongoDB.
 
-    def load_data_from_file(self, file_path):
-        """Load and process blocks from a binary file and store address values in MongoDB."""
+        With follow, keep loading new blocks while the simulation is still writing the trace, until
+        idle_timeout seconds pass without any (forever when None). NUM_BLOCK_PROCESS is ignored then.
+        """
         last_processed_index = self.get_checkpoint()
-        with open(file_path, 'rb') as fp:
+        if follow:
+            num_blocks = None
+            batches = self.iter_trace(file_path, last_processed_index, None, True, poll_interval, idle_timeout)
+        else:
             file_size = os.path.getsize(file_path)
-            num_blocks = max(file_size // 72, self.NUM_BLOCK_PROCESS)
-
-            # Move the file pointer to the last processed block
-            fp.seek(last_processed_index * 72)
-
-            with tqdm(total=num_blocks, desc="Inserting Blocks into Database", initial=last_processed_index) as pbar:
-                batch_data = {}
-                try:
-                    index = last_processed_index
-                    timestamp_counter = index + 1  # Start counter for timestamps as T1, T2, etc.
-                    while index < num_blocks:
-                        data_value = self.parse_binary_file(fp)
-                        for address, value in data_value:
-                            if address not in batch_data:
-                                batch_data[address] = []
-                            timestamp_label = f"T{timestamp_counter}"
-                            batch_data[address].append({'timestamp': timestamp_label, 'value': value})
-
-                        if len(batch_data) >= self.batch_size:
-                            self.bulk_insert(batch_data)
-                            batch_data.clear()
-                            self.update_checkpoint(index + 1)
-
-                        pbar.update(1)
-                        index += 1
-                        timestamp_counter += 1
-
-                    if batch_data:
-                        self.bulk_insert(batch_data)
-                        self.update_checkpoint(index)
-                except Exception as e:
-                    print(f"Error or End of File: {e}")
-
-    def bulk_insert(self, batch_data):
+            num_blocks = min(file_size // BLOCK_SIZE, self.NUM_BLOCK_PROCESS)
+            batches = self.iter_trace(file_path, last_processed_index, num_blocks)
+
+        with tqdm(total=num_blocks, desc="Inserting Blocks into Database", initial=last_processed_index) as pbar:
+            try:
+                for batch in batches:
+                    if self.schema == 'block':
+                        self.insert_blocks(batch)
+                    elif self.schema == 'bucket':
+                        self.insert_buckets(batch)
+                    else:
+                        self.bulk_insert(batch)
+                    self.update_checkpoint(batch.stop)
+                    pbar.update(batch.stop - batch.start)
+            except Exception as e:
+                print(f"Error or End of File: {e}")
+
+    def bulk_insert(self, batch):
         """Perform a bulk upsert of addresses and their data into MongoDB."""
+        # Group the rows by address, keeping them in timestamp order within each address
+        order = np.argsort(batch.address, kind='stable')
+        addresses, starts = np.unique(batch.address[order], return_index=True)
+        values = batch.value[order].tolist()
+        timestamps = batch.timestamp[order].tolist()
+        bounds = starts.tolist() + [len(order)]
+
         bulk_operations = [
             UpdateOne(
                 {'_id': address},
-                {'$push': {'data': {'$each': data_list}}},
+                {'$push': {'data': {'$each': [{'timestamp': f"T{timestamp}", 'value': value}
+                                              for timestamp, value in zip(timestamps[lo:hi], values[lo:hi])]}}},
                 upsert=True
             )
-            for address, data_list in batch_data.items()
+            for address, lo, hi in zip(addresses.tolist(), bounds[:-1], bounds[1:])
         ]
         if bulk_operations:
             self.collection.bulk_write(bulk_operations, ordered=False)
 
+    def insert_buckets(self, batch):
+        """Upsert the samples of a batch into per-address buckets of bucket_size consecutive timestamps."""
+        bucket = batch.timestamp // self.bucket_size
+        order = np.lexsort((batch.timestamp, bucket, batch.address))
+        addresses, bucket = batch.address[order], bucket[order]
+        new_bucket = np.ones(len(order), dtype=bool)
+        new_bucket[1:] = (addresses[1:] != addresses[:-1]) | (bucket[1:] != bucket[:-1])
+        starts = np.flatnonzero(new_bucket)
+        values = batch.value[order].tolist()
+        timestamps = batch.timestamp[order].tolist()
+        bounds = starts.tolist() + [len(order)]
+
+        # A bucket holds at most bucket_size samples, so a push never rewrites more than that. A replayed
+        # batch finds its first timestamp already in the bucket, misses it and its upsert hits the unique
+        # (address, bucket) key instead of pushing the samples twice.
+        bulk_operations = [
+            UpdateOne(
+                {'address': address, 'bucket': bucket_id, 'timestamps': {'$ne': timestamps[lo]}},
+                {'$push': {'timestamps': {'$each': timestamps[lo:hi]}, 'values': {'$each': values[lo:hi]}},
+                 '$inc': {'count': hi - lo}},
+                upsert=True
+            )
+            for address, bucket_id, lo, hi in zip(addresses[starts].tolist(), bucket[starts].tolist(),
+                                                  bounds[:-1], bounds[1:])
+        ]
+        if not bulk_operations:
+            return
+        try:
+            self.bucket_collection.bulk_write(bulk_operations, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys are groups of samples that were already applied
+            errors = e.details['writeErrors']
+            if e.details.get('writeConcernErrors') or any(error['code'] != DUPLICATE_KEY for error in errors):
+                raise
+
+    def insert_blocks(self, batch):
+        """Insert one document per writeback (line address, timestamp, 64 data bytes) into MongoDB."""
+        documents = [
+            {'line_address': address, 'timestamp': timestamp, 'data': line.tobytes()}
+            for address, timestamp, line in zip(batch.address.tolist(), batch.timestamp.tolist(), batch.data)
+        ]
+        if documents:
+            self.block_collection.insert_many(documents, ordered=False)
+
+    def fetch_address_history(self, address):
+        """Return the history of one byte address as (timestamp, value) int pairs in timestamp order.
+
+        Every schema returns the same shape, so histories compare across schemas.
+        """
+        if self.schema == 'block':
+            line_address, offset = split_address(address)
+            cursor = self.block_collection.find(
+                {'line_address': line_address},
+                {'_id': 0, 'timestamp': 1, 'data': 1}
+            ).sort('timestamp', 1)
+            return [(doc['timestamp'], doc['data'][offset]) for doc in cursor]
+
+        if self.schema == 'bucket':
+            cursor = self.bucket_collection.find(
+                {'address': address},
+                {'_id': 0, 'timestamps': 1, 'values': 1}
+            ).sort('bucket', 1)
+            return [sample for doc in cursor for sample in zip(doc['timestamps'], doc['values'])]
+
+        # Byte documents store "T{n}" text timestamps
+        doc = self.collection.find_one({'_id': address})
+        return [(int(sample['timestamp'][1:]), sample['value']) for sample in doc['data']] if doc else []
+
     def fetch_all_data(self):
         """Fetch all data entries from MongoDB and display progress with tqdm."""
+        if self.schema == 'block':
+            total_entries = self.block_collection.count_documents({})
+            with tqdm(total=total_entries, desc="Fetching Records") as pbar:
+                cursor = self.block_collection.find().sort([('line_address', 1), ('timestamp', 1)])
+                for doc in cursor:
+                    # Every writeback expands to one entry per byte of its line
+                    for offset, value in enumerate(doc['data']):
+                        print(f"Address: {doc['line_address'] + offset}, Timestamp: T{doc['timestamp']}, "
+                              f"Value: {value}")
+                    pbar.update(1)
+            return
+
+        if self.schema == 'bucket':
+            total_entries = self.bucket_collection.count_documents({})
+            with tqdm(total=total_entries, desc="Fetching Records") as pbar:
+                cursor = self.bucket_collection.find().sort([('address', 1), ('bucket', 1)])
+                for doc in cursor:
+                    data = list(zip(doc['timestamps'], doc['values']))
+                    print(f"Address: {doc['address']}, Bucket: {doc['bucket']}, Data: {data}")
+                    pbar.update(1)
+            return
+
         total_entries = self.collection.count_documents({})
 
         with tqdm(total=total_entries, desc="Fetching Records") as pbar:
@@ -1,136 +1,316 @@
 from tqdm import tqdm
 import psycopg2
-from psycopg2 import extras
-from array import array
 import os
+import time
 from multiprocessing import Pool, Manager
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
+
+from trace_reader import BLOCK_SIZE
+from pg_ingest import (INSERT_MODES, ID_MODES, SCHEMAS, PARTITION_MODES, LOOKUP_INDEXES, AddressIdCache,
+                       write_batch, write_block_batch, create_block_tables, create_unique_keys, partition_clause,
+                       adopt_partitioning, create_range_partitions, list_partitions,
+                       create_progress_table, progress_target, plan_progress, fetch_next_block,
+                       advance_progress)
+from line_state import trace_batches, check_delta
+
+# Times a batch is retried after a deadlock or serialization failure before giving up
+MAX_ROLLBACK_RETRIES = 3
+
+# Long-lived connection and address -> id cache of a pool worker, set up by init_worker
+_worker_conn = None
+_worker_connects = 0
+_worker_address_cache = None
+
+
+def init_worker(db_params, address_cache_size=0):
+    """Pool initializer: open this worker's connection and close it when the worker exits."""
+    global _worker_address_cache
+    if address_cache_size:
+        _worker_address_cache = AddressIdCache(address_cache_size)
+    get_worker_connection(db_params)
+    Finalize(None, close_worker_connection, exitpriority=10)
+
+
+def get_worker_connection(db_params):
+    """Return the worker's open connection, connecting only if there is none or it was dropped."""
+    global _worker_conn, _worker_connects
+    if _worker_conn is None or _worker_conn.closed:
+        _worker_conn = psycopg2.connect(**db_params)
+        _worker_connects += 1
+    return _worker_conn
+
+
+def close_worker_connection():
+    """Close the worker's connection if it is open."""
+    global _worker_conn
+    # Cached ids may belong to a transaction that died with the connection
+    if _worker_address_cache is not None:
+        _worker_address_cache.clear()
+    if _worker_conn is not None:
+        _worker_conn.close()
+        _worker_conn = None
+
 
 class BinaryFileParser:
-    def __init__(self, db_params, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt'):
+    def __init__(self, db_params, batch_size=100, num_block_process=None, checkpoint_file='checkpoint.txt',
+                 insert_mode='copy', id_mode='lookup', address_cache_size=2**18, schema='byte',
+                 delta=False, keep_first_write=True, idempotent=False, partition='none', partition_blocks=2**20,
+                 num_partitions=16):
+        if schema not in SCHEMAS:
+            raise ValueError(f"Unknown schema {schema!r}, expected one of {SCHEMAS}")
+        check_delta(delta, schema == 'block')
+        if insert_mode not in INSERT_MODES:
+            raise ValueError(f"Unknown insert mode {insert_mode!r}, expected one of {INSERT_MODES}")
+        if id_mode not in ID_MODES:
+            raise ValueError(f"Unknown id mode {id_mode!r}, expected one of {ID_MODES}")
+        if partition not in PARTITION_MODES:
+            raise ValueError(f"Unknown partition mode {partition!r}, expected one of {PARTITION_MODES}")
         self.db_params = db_params
+        self.insert_mode = insert_mode  # 'copy' (binary COPY), 'staging' (COPY + merge) or 'values'
+        self.id_mode = id_mode  # 'lookup' (BIGSERIAL ids) or 'derived' (id = address)
+        self.address_cache_size = address_cache_size  # 0 disables the address -> id cache
+        self.schema = schema  # 'byte' (AddressData row per byte) or 'block' (AddressBlocks row per writeback)
+        self.delta = delta  # Per-byte rows only hold changed bytes, see line_state.trace_batches
+        self.keep_first_write = keep_first_write
+        self.idempotent = idempotent  # Unique (address, timestamp) key, replayed batches insert nothing
+        # 'none', 'range' (partition_blocks timestamps per partition) or 'hash' (num_partitions on the address),
+        # only applies when the data table is created
+        self.partition = partition
+        self.partition_blocks = partition_blocks
+        self.num_partitions = num_partitions
+        self.data_table = LOOKUP_INDEXES[schema][1]
+        self.target = progress_target(schema, delta)  # Keeps checkpoints of different loads of a trace apart
         self.batch_size = batch_size
-        self.NUM_BLOCK_PROCESS = num_block_process
+        self.NUM_BLOCK_PROCESS = num_block_process  # Cap on the blocks to load, None loads the whole trace
         self.checkpoint_file = checkpoint_file
         self.create_tables()
 
+    def iter_trace(self, file_path, start=0, stop=None):
+        """Batches of blocks [start, stop) shaped for the configured schema, the block index is the timestamp."""
+        return trace_batches(file_path, self.batch_size, start, stop, self.schema == 'block', self.delta,
+                             self.keep_first_write)
+
     def create_tables(self):
         """Create normalized tables if they don't exist in PostgreSQL."""
 
         conn = psycopg2.connect(**self.db_params)
         with conn.cursor() as cur:
+            # Checkpoints live in the database so they commit atomically with the data
+            create_progress_table(cur)
+
+            if self.schema == 'block':
+                create_block_tables(cur, self.partition)
+                self.partition = adopt_partitioning(cur, self.data_table, self.partition, self.num_partitions)
+                # Same as the byte schema: no index during the load, recreate_index builds it
+                cur.execute("DROP INDEX IF EXISTS idx_line_address;")
+                if self.idempotent:
+                    create_unique_keys(cur, self.schema)
+                conn.commit()
+                conn.close()
+                return
+
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS Addresses (
                     id BIGSERIAL PRIMARY KEY,
                     address BIGINT UNIQUE
                 )
             """)
-            cur.execute("""
+            cur.execute(f"""
                 CREATE TABLE IF NOT EXISTS AddressData (
                     address_id BIGINT REFERENCES Addresses(id),
                     data SMALLINT,
                     timestamp BIGINT
-                )
+                ) {partition_clause('AddressData', self.partition)}
             """)
+            self.partition = adopt_partitioning(cur, self.data_table, self.partition, self.num_partitions)
             
             # Consider dropping index during initial load for faster bulk inserts, then recreating it
             cur.execute("DROP INDEX IF EXISTS idx_address_id;")
+            if self.idempotent:
+                create_unique_keys(cur, self.schema)
             conn.commit()
         conn.close()
 
-    def recreate_index(self):
-        """Recreate index on address_id after data has been inserted."""
+    def insert_batch(self, batch, progress=None):
+        """Perform a batch insert of addresses and data into the PostgreSQL database."""
 
-        conn = psycopg2.connect(**self.db_params)
+        # A dropped connection loses the transaction unless it had committed, so the batch is retried once
+        # on a new one when its checkpoint shows it did not commit.
+        # A deadlock or serialization failure only aborts the transaction, the connection is fine to retry on.
+        reconnects = rollbacks = 0
+        while True:
+            conn = get_worker_connection(self.db_params)
+            try:
+                with conn.cursor() as cur:
+                    if self.schema == 'block':
+                        write_block_batch(cur, batch, self.idempotent)
+                    else:
+                        write_batch(cur, batch, self.insert_mode, _worker_address_cache, self.id_mode,
+                                    self.idempotent)
+                    # The checkpoint commits with the rows, a crash can neither lose nor repeat them
+                    if progress is not None:
+                        trace, range_start = progress
+                        advance_progress(cur, trace, self.target, range_start, batch.stop)
+                conn.commit()
+                return
+            except psycopg2.extensions.TransactionRollbackError:
+                # Subclass of OperationalError, caught first so lock contention does not count as a reconnect
+                conn.rollback()
+                if _worker_address_cache is not None:
+                    _worker_address_cache.clear()
+                rollbacks += 1
+                if rollbacks > MAX_ROLLBACK_RETRIES:
+                    raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                close_worker_connection()
+                reconnects += 1
+                # The connection may have dropped after the server committed the batch, only the checkpoint
+                # tells, so without one a retry could insert the rows twice
+                if reconnects > 1 or (progress is None and not self.idempotent):
+                    raise
+                if progress is not None and self.batch_committed(batch, progress):
+                    return
+            except Exception:
+                conn.rollback()
+                if _worker_address_cache is not None:
+                    _worker_address_cache.clear()
+                raise
+
+    def batch_committed(self, batch, progress):
+        """Whether the checkpoint of the batch's range already covers it, on a freshly opened connection."""
+        trace, range_start = progress
+        conn = get_worker_connection(self.db_params)
         with conn.cursor() as cur:
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_address_id ON AddressData (address_id);")
-            conn.commit()
-        conn.close()
+            next_block = fetch_next_block(cur, trace, self.target, range_start)
+        conn.commit()
+        return next_block is not None and next_block >= batch.stop
 
-    def insert_batch(self, batch_data):
-        """Perform a batch insert of addresses and data into the PostgreSQL database."""
+    def process_file_part(self, args):
+        """Load one chunk of blocks in a pool worker and report how long it took."""
+
+        file_path, trace, range_start, next_block, range_end = args
+        started = time.perf_counter()
+        # Every worker maps the same file, so the blocks come straight from the shared page cache
+        for batch in self.iter_trace(file_path, next_block, range_end):
+            self.insert_batch(batch, progress=(trace, range_start))
+        return {
+            'pid': os.getpid(),
+            'range_start': range_start,
+            'blocks': range_end - next_block,
+            'seconds': time.perf_counter() - started,
+            'connects': _worker_connects,
+        }
+
+    def num_blocks(self, file_path):
+        """Number of blocks of the trace to load, all of them unless NUM_BLOCK_PROCESS caps it."""
+        num_blocks = os.path.getsize(file_path) // BLOCK_SIZE
+        if self.NUM_BLOCK_PROCESS is not None:
+            num_blocks = min(num_blocks, self.NUM_BLOCK_PROCESS)
+        return num_blocks
+
+    def plan_ranges(self, file_path, chunk_blocks):
+        """Return the unfinished (range_start, range_end, next_block) chunks of a load, planning them once."""
+        trace = os.path.abspath(file_path)
+        total_cache_block = self.num_blocks(file_path)
 
         conn = psycopg2.connect(**self.db_params)
         with conn.cursor() as cur:
-            address_only = list(set((address,) for address, _, _ in batch_data))
-            insert_addresses_query = """
-                INSERT INTO Addresses (address) VALUES %s
-                ON CONFLICT DO NOTHING
-            """
-            extras.execute_values(cur, insert_addresses_query, address_only)
-
-            # Step 2: Fetch all address IDs in bulk after insertion
-            address_set = list(set([address for address, _, _ in batch_data]))
-            cur.execute("SELECT id, address FROM Addresses WHERE address = ANY(%s);", (address_set,))
-            address_id_map = {address: address_id for address_id, address in cur.fetchall()}
-
-            # Prepare data for AddressData
-            address_data_batch = [(address_id_map[address], data, timestamp)
-                                  for address, data, timestamp in batch_data
-                                  if address in address_id_map]
-
-            # Bulk insert AddressData
-            insert_data_query = """
-                INSERT INTO AddressData (address_id, data, timestamp)
-                VALUES %s
-            """
-            extras.execute_values(cur, insert_data_query, address_data_batch)
+            # Ranges recorded by earlier loads, parallel or single-process, are kept and their unfinished
+            # parts cut into chunks; blocks past them are chunked anew
+            ranges = plan_progress(cur, trace, self.target, total_cache_block, chunk_blocks)
             conn.commit()
+            if self.partition == 'range':
+                # Every range partition the load reaches exists before the workers start writing
+                create_range_partitions(cur, self.data_table, range(-(-total_cache_block // self.partition_blocks)),
+                                        self.partition_blocks)
+                conn.commit()
         conn.close()
+        return ranges
 
-    @staticmethod
-    def parse_binary_file(fp, index):
-        """Generator that yields parsed address and data from a binary file."""
+    def parallel_load(self, file_path, num_processes=4, chunk_blocks=2**16):
+        """Load the trace with a pool of workers pulling chunks of chunk_blocks blocks from a queue."""
+        trace = os.path.abspath(file_path)
+        if self.delta:
+            # Every delta chunk first rebuilds the line state before it, so keep one chunk per process
+            total_cache_block = self.num_blocks(file_path)
+            chunk_blocks = max(chunk_blocks, -(-total_cache_block // num_processes))
+        pending = self.plan_ranges(file_path, max(1, chunk_blocks))
+        if not pending:
+            print("Nothing left to load.")
+            return
+        chunks = [(file_path, trace, range_start, next_block, range_end)
+                  for range_start, range_end, next_block in pending]
 
-        data = fp.read(8)
-        if len(data) != 8: return []
-        address = int.from_bytes(data, byteorder='little')
-        data_array = array('B', fp.read(64))
-        return [(address + i, value, index) for i, value in enumerate(data_array)]
+        self.chunk_stats = []
+        started = time.perf_counter()
+        pool = Pool(processes=num_processes, initializer=init_worker,
+                    initargs=(self.db_params, self.address_cache_size))
+        try:
+            # chunksize=1 makes the pool a shared queue: an idle worker takes the next chunk,
+            # so a slow chunk only holds up its own worker instead of a whole static range
+            with tqdm(total=sum(stop - next_block for _, _, _, next_block, stop in chunks),
+                      desc="Inserting Blocks into Database") as pbar:
+                for stats in pool.imap_unordered(self.process_file_part, chunks, chunksize=1):
+                    self.chunk_stats.append(stats)
+                    pbar.update(stats['blocks'])
+            wall_seconds = time.perf_counter() - started
+            # close + join lets the workers exit normally, which closes their connections
+            pool.close()
+            pool.join()
+        except BaseException:
+            pool.terminate()
+            raise
 
-    def process_file_part(self, args):
-        """Load and process a part of the binary file in a separate process."""
-
-        p, file_path, start, end, total_cache_block = args
-        total = end - start + 1
-        start_index = start // 72
-        total_index = total // 72
-        with open(file_path, 'rb') as fp:
-            batch = []
-            fp.seek(start)
-            with tqdm(total=total, desc=f"Processing Blocks : {p}", position=0, leave=False) as pbar:
-                for i in range(total_index):
-                    batch.extend(BinaryFileParser.parse_binary_file(fp, start_index+i))
-                    if len(batch) >= self.batch_size:
-                        self.insert_batch(batch)
-                        batch.clear()
-                    pbar.update(72)
-                # Insert any remaining data
-                if batch:
-                    self.insert_batch(batch)
-                pbar.close()
-
-    def parallel_load(self, file_path, num_processes=4):
-        file_size = os.path.getsize(file_path)
-        address_data_block_size = 72
-        total_cache_block = file_size // address_data_block_size
-        per_process_cache_blocks = (total_cache_block + num_processes) // num_processes
-
-        offsets = []
-        for i in range(num_processes):
-            start = i * per_process_cache_blocks * address_data_block_size
-            end = min((i+1) * per_process_cache_blocks * address_data_block_size, file_size)
-            offsets.append((i, file_path, start, end, total_cache_block))
-
-        # offsets = [(file_path, i * per_process_cache_blocks * address_data_block_size, per_process_cache_blocks, self.batch_size, total_cache_block) for i in range(num_processes)]
-        with Pool(processes=num_processes) as pool:
-            pool.map(self.process_file_part, offsets)
-
-    def recreate_index(self):
-        """Recreate index on address_id after data has been inserted."""
+        seconds = sorted(stats['seconds'] for stats in self.chunk_stats)
+        blocks = sum(stats['blocks'] for stats in self.chunk_stats)
+        # Aggregate throughput is over the wall clock of the whole pool, per worker is over the time spent in chunks
+        print(f"Chunks: {len(seconds)}, blocks: {blocks}, "
+              f"chunk seconds min/median/max: {seconds[0]:.2f}/{seconds[len(seconds) // 2]:.2f}/{seconds[-1]:.2f}, "
+              f"aggregate throughput: {blocks / max(wall_seconds, 1e-9):.0f} blocks/s, "
+              f"per worker: {blocks / max(sum(seconds), 1e-9):.0f} blocks/s")
+
+        # Connections opened per worker process, this should stay at 1 unless the server dropped us
+        self.worker_connects = {}
+        for stats in self.chunk_stats:
+            self.worker_connects[stats['pid']] = max(stats['connects'], self.worker_connects.get(stats['pid'], 0))
+        self.reconnects = sum(self.worker_connects.values()) - len(self.worker_connects)
+        print(f"Worker connections opened: {sum(self.worker_connects.values())}, reconnects: {self.reconnects}")
+
+    def create_partition_index(self, index, partition, columns):
+        """Build the index of one partition on a connection of its own."""
+        conn = psycopg2.connect(**self.db_params)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {index}_{partition} ON {partition} ({columns});")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def recreate_index(self, num_threads=4):
+        """Recreate the lookup index after data has been inserted, partitions are indexed in parallel."""
 
+        index, table, columns = LOOKUP_INDEXES[self.schema]
         conn = psycopg2.connect(**self.db_params)
         with conn.cursor() as cur:
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_address_id ON AddressData (address_id);")
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (index,))
+            exists, = cur.fetchone()
+            partitions = [] if exists else list_partitions(cur, table)
+        conn.commit()
+
+        if partitions:
+            # CREATE INDEX on the parent would build the partitions one after another, so build them
+            # side by side and attach them to an index created on the parent only
+            with ThreadPool(min(num_threads, len(partitions))) as pool:
+                pool.starmap(self.create_partition_index, [(index, partition, columns) for partition in partitions])
+            with conn.cursor() as cur:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {index} ON ONLY {table} ({columns});")
+                for partition in partitions:
+                    cur.execute(f"ALTER INDEX {index} ATTACH PARTITION {index}_{partition};")
+            conn.commit()
+        elif not exists:
+            with conn.cursor() as cur:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns});")
             conn.commit()
         conn.close()
 
@@ -143,6 +323,6 @@ if __name__ == "__main__":
         'port': 5432
     }
 
-    parser = BinaryFileParser(db_params=db_params, batch_size=2**14, num_block_process=2**60)
+    parser = BinaryFileParser(db_params=db_params, batch_size=2**14)
     parser.parallel_load("../data/data.log", num_processes=32)
     parser.recreate_index()  # Recreate index after the load for faster query operations
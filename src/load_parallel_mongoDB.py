@@ -0,0 +1,165 @@
+from tqdm import tqdm
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+
+import numpy as np
+
+from trace_reader import BLOCK_SIZE, LINE_SIZE, BlockBatch, TraceReader, iter_block_batches, explode_block_batch
+from line_state import LineState, check_delta
+from trace_stats import mix64
+import load_data_mongoDB
+
+# Single process loader of a pool worker, with its own MongoClient, set up by init_worker
+_worker_parser = None
+
+
+def init_worker(db_params, options):
+    """Pool initializer: connect this worker and close the client when the worker exits."""
+    global _worker_parser
+    # MongoClient is not fork-safe, so every worker opens its own after the fork
+    _worker_parser = load_data_mongoDB.BinaryFileParserMongoDB(db_params, **options)
+    Finalize(None, close_worker_parser, exitpriority=10)
+
+
+def close_worker_parser():
+    """Close the worker's client if it is open."""
+    global _worker_parser
+    if _worker_parser is not None:
+        _worker_parser.close()
+        _worker_parser = None
+
+
+def shard_of(line_addresses, num_shards):
+    """Shard owning each line address. All bytes of a line land in one shard, so do their documents."""
+    return (mix64(line_addresses) % np.uint64(num_shards)).astype(np.int64)
+
+
+class BinaryFileParserMongoDB:
+    def __init__(self, db_params, batch_size=100, num_block_process=10, checkpoint_file='checkpoint.txt',
+                 schema='byte', delta=False, keep_first_write=True, bucket_size=2**12, write_concern=None):
+        if schema not in load_data_mongoDB.SCHEMAS:
+            raise ValueError(f"Unknown schema {schema!r}, expected one of {load_data_mongoDB.SCHEMAS}")
+        check_delta(delta, schema == 'block')
+        self.db_params = db_params
+        self.batch_size = batch_size
+        self.NUM_BLOCK_PROCESS = num_block_process
+        self.checkpoint_file = checkpoint_file
+        self.schema = schema
+        self.delta = delta  # Per-byte rows only hold changed bytes, see line_state.trace_batches
+        self.keep_first_write = keep_first_write
+        # Options of the single process loader every worker runs
+        self.options = {
+            'batch_size': batch_size,
+            'schema': schema,
+            'delta': delta,
+            'keep_first_write': keep_first_write,
+            'bucket_size': bucket_size,
+            'write_concern': write_concern,  # e.g. {'w': 1, 'j': False}, None keeps the server default
+        }
+        self.create_indexes()
+
+    def create_indexes(self):
+        """Create the indexes of the configured schema before any worker starts writing."""
+        # The client is closed again before the pool forks
+        parser = load_data_mongoDB.BinaryFileParserMongoDB(self.db_params, **self.options)
+        parser.create_indexes()
+        parser.close()
+
+    def shard_checkpoint_file(self, shard, num_shards):
+        """Checkpoint file of one shard, a different shard count starts from scratch."""
+        return f"{self.checkpoint_file}.shard{shard}of{num_shards}"
+
+    def get_checkpoint(self, shard, num_shards):
+        """Retrieve the last processed block index of a shard from its checkpoint file."""
+        checkpoint_file = self.shard_checkpoint_file(shard, num_shards)
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'r') as f:
+                return int(f.read().strip())
+        return 0
+
+    def update_checkpoint(self, shard, num_shards, last_processed_index):
+        """Update the checkpoint file of a shard with the last processed block index."""
+        with open(self.shard_checkpoint_file(shard, num_shards), 'w') as f:
+            f.write(str(last_processed_index))
+
+    def process_shard(self, args):
+        """Load the lines of one shard in a pool worker and report its throughput."""
+        file_path, shard, num_shards, stop = args
+        start = self.get_checkpoint(shard, num_shards)
+        started = time.perf_counter()
+        rows = 0
+
+        state = LineState(self.keep_first_write) if self.delta else None
+        if state is not None and start:
+            # A line's deltas only depend on the line itself, the shard's lines are primed like any others
+            with TraceReader(file_path) as trace:
+                state.prime(trace, min(start, len(trace)))
+
+        # Every worker scans the whole trace from the shared page cache and keeps about 1 / num_shards
+        # of it, so scan num_shards times more blocks per batch to write batch_size sized batches
+        blocks_per_batch = self.batch_size if self.schema == 'block' else max(1, self.batch_size // LINE_SIZE)
+        for batch in iter_block_batches(file_path, blocks_per_batch * num_shards, start, stop, timestamp_offset=1):
+            mine = shard_of(batch.address, num_shards) == shard
+            batch = BlockBatch(batch.address[mine], batch.data[mine], batch.timestamp[mine], batch.start, batch.stop)
+            if self.schema == 'block':
+                _worker_parser.insert_blocks(batch)
+                rows += len(batch.address)
+            else:
+                batch = state.apply(batch) if state is not None else explode_block_batch(batch)
+                if self.schema == 'bucket':
+                    _worker_parser.insert_buckets(batch)
+                else:
+                    _worker_parser.bulk_insert(batch)
+                rows += len(batch.address)
+            self.update_checkpoint(shard, num_shards, batch.stop)
+
+        return {
+            'pid': os.getpid(),
+            'shard': shard,
+            'blocks': max(0, stop - start),
+            'rows': rows,
+            'seconds': time.perf_counter() - started,
+        }
+
+    def parallel_load(self, file_path, num_processes=4):
+        """Load the trace with one worker per address shard, each issuing unordered bulk writes to its own documents."""
+        total_cache_block = min(os.path.getsize(file_path) // BLOCK_SIZE, self.NUM_BLOCK_PROCESS)
+        shards = [(file_path, shard, num_processes, total_cache_block) for shard in range(num_processes)]
+
+        self.shard_stats = []
+        pool = Pool(processes=num_processes, initializer=init_worker, initargs=(self.db_params, self.options))
+        try:
+            with tqdm(total=num_processes, desc="Loading Shards into Database") as pbar:
+                for stats in pool.imap_unordered(self.process_shard, shards, chunksize=1):
+                    self.shard_stats.append(stats)
+                    pbar.update(1)
+            # close + join lets the workers exit normally, which closes their clients
+            pool.close()
+            pool.join()
+        except BaseException:
+            pool.terminate()
+            raise
+
+        for stats in sorted(self.shard_stats, key=lambda stats: stats['shard']):
+            print(f"Shard {stats['shard']} (pid {stats['pid']}): {stats['rows']} rows in {stats['seconds']:.2f}s, "
+                  f"{stats['rows'] / max(stats['seconds'], 1e-9):.0f} rows/s")
+        rows = sum(stats['rows'] for stats in self.shard_stats)
+        seconds = max((stats['seconds'] for stats in self.shard_stats), default=0)
+        print(f"Total: {rows} rows in {seconds:.2f}s, {rows / max(seconds, 1e-9):.0f} rows/s")
+
+
+if __name__ == "__main__":
+    db_params = {
+        'host': 'localhost',
+        'port': 27017,
+        'username': 'root',
+        'password': 'example',
+        'authSource': 'admin',
+        'database': 'mydatabase'
+    }
+
+    parser = BinaryFileParserMongoDB(db_params=db_params, batch_size=2**14, num_block_process=2**60,
+                                     schema='bucket', write_concern={'w': 1, 'j': False})
+    parser.parallel_load("../data/data.log", num_processes=os.cpu_count())
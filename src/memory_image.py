@@ -0,0 +1,91 @@
+import json
+
+import numpy as np
+
+from trace_reader import LINE_SIZE, TraceReader, iter_block_batches
+from line_state import LineState
+
+
+def find_regions(lines):
+    """Runs of consecutive lines in a sorted line address array, as (first, stop) index pairs."""
+    if not len(lines):
+        return []
+    breaks = np.flatnonzero(np.diff(lines) != LINE_SIZE) + 1
+    firsts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(lines)]))
+    return list(zip(firsts.tolist(), stops.tolist()))
+
+
+def write_image(path, lines, data, block_index=None, base=0):
+    """Write a raw physical memory image and its JSON region map, path + '.json'.
+
+    The byte at address a sits at file offset a - base, untouched ranges are left as holes, so
+    the image is sparse on disk and reads as zero-filled memory, the layout memory forensics
+    tools expect from a raw (padded) dump. Returns the region map.
+    """
+    if len(lines) and int(lines[0]) < base:
+        raise ValueError(f"Line {int(lines[0]):#x} lies below the image base {base:#x}")
+
+    regions = []
+    with open(path, 'wb') as f:
+        for first, stop in find_regions(lines):
+            start = int(lines[first])
+            f.seek(start - base)
+            f.write(data[first:stop].tobytes())
+            regions.append({'start': start, 'size': (stop - first) * LINE_SIZE, 'offset': start - base})
+        # Extend the file over the last region even if nothing was written
+        f.truncate(int(lines[-1]) + LINE_SIZE - base if len(lines) else 0)
+
+    region_map = {
+        'image': path,
+        'format': 'raw',
+        'base': base,
+        'line_size': LINE_SIZE,
+        'block_index': block_index,
+        'lines': len(lines),
+        'regions': regions,
+    }
+    with open(path + '.json', 'w') as f:
+        json.dump(region_map, f, indent=2)
+    return region_map
+
+
+def export_images(file_path, block_indices, path_format='memory.T{}.raw', base=0, batch_size=2**16):
+    """Write the memory image as of each block index in one sequential pass over a trace.
+
+    Every image holds the contents of all lines written back in blocks [0, T], it is written as
+    soon as the pass reaches T. Returns the region maps in block index order.
+    """
+    with TraceReader(file_path) as trace:
+        num_blocks = len(trace)
+    checkpoints = sorted(set(block_indices))
+    if checkpoints and not 0 <= checkpoints[0] <= checkpoints[-1] < num_blocks:
+        raise ValueError(f"Block indices must lie in [0, {num_blocks})")
+
+    state = LineState()
+    region_maps = []
+    stop = checkpoints[-1] + 1 if checkpoints else 0
+    for batch in iter_block_batches(file_path, batch_size, 0, stop):
+        first = 0
+        while first < len(batch.address):
+            # Advance the state up to the next checkpoint inside this batch, or to its end
+            upto = len(batch.address)
+            if checkpoints and checkpoints[0] < batch.stop:
+                upto = checkpoints[0] + 1 - batch.start
+            lines, last = np.unique(batch.address[first:upto][::-1], return_index=True)
+            state.store(lines, batch.data[upto - 1 - last])
+            first = upto
+
+            if checkpoints and batch.start + upto - 1 == checkpoints[0]:
+                block_index = checkpoints.pop(0)
+                region_maps.append(write_image(path_format.format(block_index), state.lines, state.data,
+                                               block_index, base))
+    return region_maps
+
+
+if __name__ == "__main__":
+    with TraceReader("../data/data.log") as trace:
+        num_blocks = len(trace)
+    # Quarter points of the run and its end state
+    export_images("../data/data.log", [num_blocks * k // 4 - 1 for k in range(1, 5) if num_blocks * k // 4],
+                  path_format="../data/memory.T{}.raw")
@@ -0,0 +1,530 @@
+import io
+from collections import OrderedDict
+import numpy as np
+from psycopg2 import extras
+
+from trace_reader import LINE_SIZE
+
+# Binary COPY framing: signature, flags field and header extension length, then -1 as trailer
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + (0).to_bytes(4, 'big') + (0).to_bytes(4, 'big')
+PGCOPY_TRAILER = (-1).to_bytes(2, 'big', signed=True)
+
+# Network byte order wire formats of the column types we load
+PG_BINARY_TYPES = {
+    'smallint': np.dtype('>i2'),
+    'integer': np.dtype('>i4'),
+    'bigint': np.dtype('>i8'),
+}
+
+INSERT_MODES = ('values', 'copy', 'staging')
+
+# 'lookup': Addresses.id comes from the BIGSERIAL sequence and has to be looked up.
+# 'derived': Addresses.id is the address itself, so rows never need a lookup. Do not mix
+# both modes in one database, derived ids would collide with sequence-assigned ones.
+ID_MODES = ('lookup', 'derived')
+
+# 'byte': one AddressData row per traced byte. 'block': one AddressBlocks row per writeback.
+SCHEMAS = ('byte', 'block')
+
+# Sinks of a full export: CSV or Postgres binary COPY files, or .npy files of EXPORT_DTYPE rows
+EXPORT_FORMATS = ('csv', 'binary', 'numpy')
+EXPORT_DTYPE = np.dtype([('address', '<i8'), ('data', '<i2'), ('timestamp', '<i8')])
+
+# 'none': one heap. 'range': a partition per partition_blocks timestamps, created as the load
+# reaches them. 'hash': num_partitions partitions on the address, created with the table.
+PARTITION_MODES = ('none', 'range', 'hash')
+
+# Partition key of each data table, per partition mode
+PARTITION_KEYS = {
+    'AddressData': {'range': 'timestamp', 'hash': 'address_id'},
+    'AddressBlocks': {'range': 'timestamp', 'hash': 'line_address'},
+}
+
+# Lookup index of each schema's data table: name, table, columns
+LOOKUP_INDEXES = {
+    'byte': ('idx_address_id', 'AddressData', 'address_id'),
+    'block': ('idx_line_address', 'AddressBlocks', 'line_address, timestamp'),
+}
+
+
+def binary_wire_type(pg_type, values):
+    """Wire dtype of one column, bytea columns are fixed-width rows of a 2-D uint8 array."""
+    if pg_type == 'bytea':
+        return np.dtype(('u1', (values.shape[1],)))
+    return PG_BINARY_TYPES[pg_type]
+
+
+def binary_copy_stream(columns):
+    """Encode (name, pg_type, array) columns as a binary COPY stream, built row-wise by NumPy."""
+    wire_types = [binary_wire_type(pg_type, values) for _, pg_type, values in columns]
+    fields = [('nfields', '>i2')]
+    for i, wire_type in enumerate(wire_types):
+        fields += [(f'len{i}', '>i4'), (f'col{i}', wire_type)]
+
+    rows = np.empty(len(columns[0][2]), dtype=fields)
+    rows['nfields'] = len(columns)
+    for i, (wire_type, (_, _, values)) in enumerate(zip(wire_types, columns)):
+        rows[f'len{i}'] = wire_type.itemsize
+        rows[f'col{i}'] = values
+
+    stream = io.BytesIO()
+    stream.write(PGCOPY_HEADER)
+    stream.write(rows.data)
+    stream.write(PGCOPY_TRAILER)
+    stream.seek(0)
+    return stream
+
+
+def copy_rows(cur, table, columns):
+    """COPY the given (name, pg_type, array) columns into table using the binary format."""
+    names = ', '.join(name for name, _, _ in columns)
+    cur.copy_expert(f"COPY {table} ({names}) FROM STDIN WITH (FORMAT binary)", binary_copy_stream(columns))
+
+
+class AddressIdCache:
+    """Bounded LRU map of address -> Addresses.id kept by one loader process."""
+
+    def __init__(self, max_size=2**18):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def lookup(self, addresses):
+        """Split addresses into a dict of cached ids and the list of addresses not cached."""
+        found = {}
+        missing = []
+        for address in addresses:
+            address_id = self._ids.get(address)
+            if address_id is None:
+                missing.append(address)
+            else:
+                self._ids.move_to_end(address)
+                found[address] = address_id
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def update(self, address_ids):
+        """Remember address -> id pairs, evicting the least recently used ones beyond max_size."""
+        self._ids.update(address_ids)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def clear(self):
+        """Forget every cached id, e.g. after a rollback undid the inserts they came from."""
+        self._ids.clear()
+
+
+def resolve_address_ids(cur, addresses, address_cache=None, id_mode='lookup'):
+    """Insert any new addresses and return the Addresses.id of every entry in addresses."""
+    if id_mode == 'derived':
+        return insert_derived_addresses(cur, addresses, address_cache)
+
+    unique_addresses, inverse = np.unique(addresses, return_inverse=True)
+    unique_list = unique_addresses.tolist()
+    if address_cache is None:
+        address_id_map, missing = {}, unique_list
+    else:
+        address_id_map, missing = address_cache.lookup(unique_list)
+
+    # Only addresses this process has not seen recently cost a round trip
+    if missing:
+        extras.execute_values(cur, """
+            INSERT INTO Addresses (address) VALUES %s
+            ON CONFLICT DO NOTHING
+        """, [(address,) for address in missing])
+        cur.execute("SELECT id, address FROM Addresses WHERE address = ANY(%s);", (missing,))
+        fetched = {address: address_id for address_id, address in cur.fetchall()}
+        address_id_map.update(fetched)
+        if address_cache is not None:
+            address_cache.update(fetched)
+
+    # Broadcast the ids back over the rows
+    return np.array([address_id_map[address] for address in unique_list], dtype=np.int64)[inverse]
+
+
+def insert_derived_addresses(cur, addresses, address_cache=None):
+    """Make sure addresses exist in Addresses with id = address and return them as ids."""
+    unique_list = np.unique(addresses).tolist()
+    if address_cache is None:
+        missing = unique_list
+    else:
+        _, missing = address_cache.lookup(unique_list)
+
+    if missing:
+        extras.execute_values(cur, """
+            INSERT INTO Addresses (id, address) VALUES %s
+            ON CONFLICT DO NOTHING
+        """, [(address, address) for address in missing])
+        if address_cache is not None:
+            address_cache.update((address, address) for address in missing)
+    return addresses.astype(np.int64)
+
+
+def insert_address_data_values(cur, address_ids, values, timestamps, idempotent=False):
+    """Insert AddressData rows through a rendered INSERT ... VALUES statement."""
+    on_conflict = "ON CONFLICT (address_id, timestamp) DO NOTHING" if idempotent else ""
+    extras.execute_values(cur, f"""
+        INSERT INTO AddressData (address_id, data, timestamp)
+        VALUES %s {on_conflict}
+    """, list(zip(address_ids.tolist(), values.tolist(), timestamps.tolist())))
+
+
+def copy_address_data(cur, address_ids, values, timestamps):
+    """Stream AddressData rows with binary COPY, no SQL text is generated per row."""
+    copy_rows(cur, 'AddressData', [
+        ('address_id', 'bigint', address_ids),
+        ('data', 'smallint', values),
+        ('timestamp', 'bigint', timestamps),
+    ])
+
+
+def create_staging_table(cur):
+    """Create the per-connection staging table used by merge_staged_batch."""
+    # Temporary tables are never WAL-logged (like UNLOGGED ones) and are private to the
+    # connection, so parallel workers can stage at the same time without colliding.
+    cur.execute("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS AddressStaging (
+            address BIGINT,
+            data SMALLINT,
+            timestamp BIGINT
+        ) ON COMMIT DELETE ROWS
+    """)
+
+
+def merge_staged_batch(cur, batch, id_mode='lookup', idempotent=False):
+    """COPY raw (address, data, timestamp) rows into staging and merge them into the normalized tables."""
+    on_conflict = "ON CONFLICT (address_id, timestamp) DO NOTHING" if idempotent else ""
+    create_staging_table(cur)
+    copy_rows(cur, 'AddressStaging', [
+        ('address', 'bigint', batch.address),
+        ('data', 'smallint', batch.value),
+        ('timestamp', 'bigint', batch.timestamp),
+    ])
+
+    if id_mode == 'derived':
+        cur.execute("""
+            INSERT INTO Addresses (id, address)
+            SELECT DISTINCT address, address FROM AddressStaging
+            ON CONFLICT DO NOTHING
+        """)
+        cur.execute(f"""
+            INSERT INTO AddressData (address_id, data, timestamp)
+            SELECT address, data, timestamp FROM AddressStaging
+            {on_conflict}
+        """)
+        return
+
+    # New addresses go in first so the merge below sees ids committed concurrently by other workers
+    cur.execute("""
+        INSERT INTO Addresses (address)
+        SELECT DISTINCT address FROM AddressStaging
+        ON CONFLICT DO NOTHING
+    """)
+    cur.execute(f"""
+        INSERT INTO AddressData (address_id, data, timestamp)
+        SELECT Addresses.id, AddressStaging.data, AddressStaging.timestamp
+        FROM AddressStaging
+        JOIN Addresses ON Addresses.address = AddressStaging.address
+        {on_conflict}
+    """)
+
+
+def partition_clause(table, partition='none'):
+    """PARTITION BY clause of a data table for a partition mode, empty for 'none'."""
+    if partition == 'none':
+        return ""
+    return f"PARTITION BY {partition.upper()} ({PARTITION_KEYS[table][partition]})"
+
+
+def create_hash_partitions(cur, table, num_partitions):
+    """Create all num_partitions partitions of a hash-partitioned table."""
+    for remainder in range(num_partitions):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}_h{remainder} PARTITION OF {table}
+            FOR VALUES WITH (MODULUS {num_partitions}, REMAINDER {remainder})
+        """)
+
+
+def range_partitions(timestamps, partition_blocks):
+    """Numbers of the range partitions holding the given timestamps."""
+    if not len(timestamps):
+        return set()
+    return set(range(int(timestamps.min()) // partition_blocks, int(timestamps.max()) // partition_blocks + 1))
+
+
+def create_range_partitions(cur, table, partitions, partition_blocks):
+    """Create range partitions by number, partition k holds timestamps [k, k + 1) * partition_blocks."""
+    # Concurrent loaders may reach the same new range at once, take turns creating it
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (table,))
+    for k in sorted(partitions):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}_p{k} PARTITION OF {table}
+            FOR VALUES FROM ({k * partition_blocks}) TO ({(k + 1) * partition_blocks})
+        """)
+
+
+def list_partitions(cur, table):
+    """Names of the partitions of a table, empty if it is not partitioned."""
+    cur.execute("""
+        SELECT inhrelid::regclass::text FROM pg_inherits
+        WHERE inhparent = to_regclass(%s) ORDER BY 1
+    """, (table,))
+    return [name for name, in cur.fetchall()]
+
+
+def table_partitioning(cur, table):
+    """Partition mode an existing table was created with, 'none' for a plain table."""
+    cur.execute("SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    if row is None:
+        return 'none'
+    strategy = {'r': 'range', 'h': 'hash'}.get(row[0])
+    if strategy is None:
+        raise ValueError(f"{table} uses partition strategy {row[0]!r}, expected one of {PARTITION_MODES}")
+    return strategy
+
+
+def setup_partitions(cur, table, num_partitions=16):
+    """Return the partition mode of a freshly ensured data table, creating its hash partitions if it has none yet.
+
+    CREATE TABLE IF NOT EXISTS leaves an existing table as it is, so this is the mode the table
+    really has, not necessarily the one it was asked to be created with.
+    """
+    partition = table_partitioning(cur, table)
+    if partition == 'hash' and not list_partitions(cur, table):
+        create_hash_partitions(cur, table, num_partitions)
+    return partition
+
+
+def adopt_partitioning(cur, table, partition, num_partitions=16):
+    """Partition mode a freshly ensured data table really has, the one to load it with.
+
+    An existing table keeps the mode it was created with, a notice is printed when that differs from partition.
+    """
+    actual = setup_partitions(cur, table, num_partitions)
+    if actual != partition:
+        print(f"{table} already exists with partition mode {actual!r}, using it instead of {partition!r}")
+    return actual
+
+
+def create_block_tables(cur, partition='none'):
+    """Create the block-granular schema, one AddressBlocks row per 64-byte writeback."""
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS AddressBlocks (
+            line_address BIGINT,
+            data BYTEA,
+            timestamp BIGINT
+        ) {partition_clause('AddressBlocks', partition)}
+    """)
+
+    # Per-byte rows over the blocks, the same shape as joining Addresses and AddressData
+    cur.execute("""
+        CREATE OR REPLACE VIEW AddressBlockBytes AS
+        SELECT AddressBlocks.line_address + offsets.i AS address,
+               get_byte(AddressBlocks.data, offsets.i)::SMALLINT AS data,
+               AddressBlocks.timestamp
+        FROM AddressBlocks
+        CROSS JOIN LATERAL generate_series(0, length(AddressBlocks.data) - 1) AS offsets(i)
+    """)
+
+    # History of one byte, served from the (line_address, timestamp) index
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION address_history(byte_address BIGINT)
+        RETURNS TABLE (data SMALLINT, timestamp BIGINT) AS $$
+            SELECT get_byte(AddressBlocks.data, (byte_address % {LINE_SIZE})::INT)::SMALLINT,
+                   AddressBlocks.timestamp
+            FROM AddressBlocks
+            WHERE AddressBlocks.line_address = byte_address - byte_address % {LINE_SIZE}
+            ORDER BY AddressBlocks.timestamp
+        $$ LANGUAGE sql STABLE
+    """)
+
+
+def create_block_index(cur):
+    """Index AddressBlocks for per-line history lookups."""
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_line_address ON AddressBlocks (line_address, timestamp);")
+
+
+def copy_address_blocks(cur, batch, table='AddressBlocks'):
+    """Stream a BlockBatch into AddressBlocks with binary COPY, one row per writeback."""
+    copy_rows(cur, table, [
+        ('line_address', 'bigint', batch.address),
+        ('data', 'bytea', batch.data),
+        ('timestamp', 'bigint', batch.timestamp),
+    ])
+
+
+def merge_staged_blocks(cur, batch):
+    """COPY a BlockBatch into staging and insert the writebacks not already in AddressBlocks."""
+    cur.execute("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS AddressBlockStaging (
+            line_address BIGINT,
+            data BYTEA,
+            timestamp BIGINT
+        ) ON COMMIT DELETE ROWS
+    """)
+    copy_address_blocks(cur, batch, 'AddressBlockStaging')
+    cur.execute("""
+        INSERT INTO AddressBlocks (line_address, data, timestamp)
+        SELECT line_address, data, timestamp FROM AddressBlockStaging
+        ON CONFLICT (line_address, timestamp) DO NOTHING
+    """)
+
+
+def create_unique_keys(cur, schema='byte'):
+    """Unique key on (address, timestamp) so a replayed batch inserts nothing twice."""
+    if schema == 'block':
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_address_blocks ON AddressBlocks (line_address, timestamp);")
+    else:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_address_data ON AddressData (address_id, timestamp);")
+
+
+def write_block_batch(cur, batch, idempotent=False):
+    """Write one BlockBatch into AddressBlocks."""
+    if idempotent:
+        merge_staged_blocks(cur, batch)
+    else:
+        copy_address_blocks(cur, batch)
+
+
+def write_batch(cur, batch, insert_mode='copy', address_cache=None, id_mode='lookup', idempotent=False):
+    """Write one AddressBatch into Addresses/AddressData using the chosen insert mode."""
+    # COPY cannot skip conflicting rows, so idempotent COPY goes through the staging merge
+    if insert_mode == 'staging' or (idempotent and insert_mode == 'copy'):
+        merge_staged_batch(cur, batch, id_mode, idempotent)
+        return
+
+    address_ids = resolve_address_ids(cur, batch.address, address_cache, id_mode)
+    if insert_mode == 'copy':
+        copy_address_data(cur, address_ids, batch.value, batch.timestamp)
+    elif insert_mode == 'values':
+        insert_address_data_values(cur, address_ids, batch.value, batch.timestamp, idempotent)
+    else:
+        raise ValueError(f"Unknown insert mode {insert_mode!r}, expected one of {INSERT_MODES}")
+
+
+def progress_target(schema='byte', delta=False):
+    """What a load writes, the second part of its LoadProgress key: the data table, and ':delta' for delta rows."""
+    table = 'AddressBlocks' if schema == 'block' else 'AddressData'
+    return table + ':delta' if delta else table
+
+
+def create_progress_table(cur):
+    """Create LoadProgress, the load checkpoints that commit together with the data."""
+    # One row per block range [range_start, range_end) of a trace loaded into a target, next_block
+    # is the first block of the range whose data is not committed yet
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS LoadProgress (
+            trace TEXT,
+            target TEXT,
+            range_start BIGINT,
+            range_end BIGINT,
+            next_block BIGINT,
+            PRIMARY KEY (trace, target, range_start)
+        )
+    """)
+
+
+def fetch_progress(cur, trace, target):
+    """Return the (range_start, range_end, next_block) ranges recorded for a trace and target."""
+    cur.execute("""
+        SELECT range_start, range_end, next_block FROM LoadProgress
+        WHERE trace = %s AND target = %s ORDER BY range_start
+    """, (trace, target))
+    return cur.fetchall()
+
+
+def fetch_next_block(cur, trace, target, range_start):
+    """First block of a recorded range whose data is not committed yet, None if there is no such range."""
+    cur.execute("""
+        SELECT next_block FROM LoadProgress
+        WHERE trace = %s AND target = %s AND range_start = %s
+    """, (trace, target, range_start))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+
+def register_ranges(cur, trace, target, ranges):
+    """Record (range_start, range_end, next_block) ranges for a trace and target, keeping existing ones."""
+    extras.execute_values(cur, """
+        INSERT INTO LoadProgress (trace, target, range_start, range_end, next_block) VALUES %s
+        ON CONFLICT (trace, target, range_start) DO NOTHING
+    """, [(trace, target, range_start, range_end, next_block) for range_start, range_end, next_block in ranges])
+
+
+def plan_progress(cur, trace, target, num_blocks, chunk_blocks=None):
+    """Return the unfinished (range_start, range_end, next_block) ranges of a load of blocks [0, num_blocks).
+
+    Ranges recorded by earlier loads, single-process or parallel, are picked up where they stopped.
+    Unfinished ones are split into pieces of at most chunk_blocks blocks and blocks past the last
+    recorded range get new ranges, None keeps every range whole. Only the returned ranges are cut
+    at num_blocks, the recorded ones keep their ends for a later, longer load.
+    """
+    ranges = fetch_progress(cur, trace, target)
+    end = max((range_end for _, range_end, _ in ranges), default=0)
+    step = chunk_blocks or max(num_blocks - end, 1)
+    new_ranges = [(start, min(start + step, num_blocks), start) for start in range(end, num_blocks, step)]
+    for range_start, range_end, next_block in ranges:
+        if chunk_blocks is None or range_end - next_block <= chunk_blocks or next_block >= num_blocks:
+            continue
+        new_ranges += [(start, min(start + chunk_blocks, range_end), start)
+                       for start in range(next_block + chunk_blocks, range_end, chunk_blocks)]
+        cur.execute("""
+            UPDATE LoadProgress SET range_end = %s
+            WHERE trace = %s AND target = %s AND range_start = %s
+        """, (next_block + chunk_blocks, trace, target, range_start))
+    if new_ranges:
+        register_ranges(cur, trace, target, new_ranges)
+    ranges = [(range_start, min(range_end, num_blocks), next_block)
+              for range_start, range_end, next_block in fetch_progress(cur, trace, target)]
+    return [(range_start, range_end, next_block) for range_start, range_end, next_block in ranges
+            if next_block < range_end]
+
+
+def advance_progress(cur, trace, target, range_start, next_block):
+    """Move a range's checkpoint forward, call it in the transaction that wrote the blocks."""
+    # A followed trace keeps growing, its last range grows with it
+    cur.execute("""
+        UPDATE LoadProgress SET next_block = %s, range_end = GREATEST(range_end, %s)
+        WHERE trace = %s AND target = %s AND range_start = %s
+    """, (next_block, next_block, trace, target, range_start))
+
+
+def iter_row_chunks(conn, query, itersize=2**16, name='export_rows'):
+    """Stream the rows of a query in lists of up to itersize rows from a named server-side cursor.
+
+    Only one chunk is held on the client at a time. The cursor lives in the connection's open
+    transaction, which the caller ends once it is done.
+    """
+    with conn.cursor(name=name) as cur:
+        cur.itersize = itersize
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                return
+            yield rows
+
+
+def copy_query_to(cur, query, fp, export_format='csv'):
+    """Stream the result of a query into a binary file object with COPY TO STDOUT."""
+    options = "FORMAT csv, HEADER" if export_format == 'csv' else "FORMAT binary"
+    cur.copy_expert(f"COPY ({query}) TO STDOUT WITH ({options})", fp)
+
+
+def export_numpy_chunks(conn, query, path_format, itersize=2**16):
+    """Write the (address, data, timestamp) rows of a query as .npy files of up to itersize rows.
+
+    Chunk i goes to path_format.format(i), the paths are returned in row order.
+    """
+    paths = []
+    for i, rows in enumerate(iter_row_chunks(conn, query, itersize)):
+        path = path_format.format(i)
+        np.save(path, np.array(rows, dtype=EXPORT_DTYPE))
+        paths.append(path)
+    return paths
@@ -0,0 +1,159 @@
+import mmap
+import os
+import stat
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Layout of one record appended to data.log by BaseCache::writebackBlk:
+# the little-endian block address followed by the 64 bytes of the line.
+ADDRESS_SIZE = 8
+LINE_SIZE = 64
+BLOCK_SIZE = ADDRESS_SIZE + LINE_SIZE
+
+BLOCK_DTYPE = np.dtype([('address', '<u8'), ('data', 'u1', (LINE_SIZE,))])
+
+_LINE_OFFSETS = np.arange(LINE_SIZE, dtype=np.uint64)
+
+# Columnar per-byte rows for the blocks [start, stop) of the trace
+AddressBatch = namedtuple('AddressBatch', ['address', 'value', 'timestamp', 'start', 'stop'])
+
+# Columnar per-writeback rows: line address, (n, 64) line data and timestamp of every block
+BlockBatch = namedtuple('BlockBatch', ['address', 'data', 'timestamp', 'start', 'stop'])
+
+
+def decode_blocks(buf, offset=0, count=-1):
+    """View whole 72-byte blocks of a bytes-like buffer as a structured array without copying."""
+    if count < 0:
+        count = (len(buf) - offset) // BLOCK_SIZE
+    return np.frombuffer(buf, dtype=BLOCK_DTYPE, count=count, offset=offset)
+
+
+def split_address(address):
+    """Split a byte address into the line address holding it and its offset within that line."""
+    offset = address % LINE_SIZE
+    return address - offset, offset
+
+
+def explode_blocks(blocks, start_index=0):
+    """Expand blocks into per-byte (address, value, timestamp) columns, 64 rows per block."""
+    num_blocks = len(blocks)
+    address = (blocks['address'][:, None] + _LINE_OFFSETS).reshape(-1)
+    value = blocks['data'].reshape(-1)
+    timestamp = np.repeat(np.arange(start_index, start_index + num_blocks, dtype=np.int64), LINE_SIZE)
+    return address, value, timestamp
+
+
+def explode_block_batch(batch):
+    """Per-byte AddressBatch rows of a BlockBatch, 64 rows per writeback."""
+    address = (batch.address[:, None] + _LINE_OFFSETS).reshape(-1)
+    timestamp = np.repeat(batch.timestamp, LINE_SIZE)
+    return AddressBatch(address, batch.data.reshape(-1), timestamp, batch.start, batch.stop)
+
+
+class TraceReader:
+    """Random-access, zero-copy view of a data.log trace backed by a shared memory mapping."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._fp = open(file_path, 'rb')
+        size = os.fstat(self._fp.fileno()).st_size
+        if size >= BLOCK_SIZE:
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.blocks = decode_blocks(self._mm)
+        else:
+            # mmap refuses empty files, an empty trace is still a valid trace
+            self._mm = None
+            self.blocks = np.empty(0, dtype=BLOCK_DTYPE)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, index):
+        """Block record(s) at a block index or slice, as views into the mapping."""
+        return self.blocks[index]
+
+    def close(self):
+        """Release the mapping and the underlying file."""
+        self.blocks = np.empty(0, dtype=BLOCK_DTYPE)
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # Views handed out are still alive, the mapping goes away with them
+                pass
+            self._mm = None
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_batches(file_path, batch_size, start=0, stop=None, timestamp_offset=0):
+    """Yield AddressBatch columns of about batch_size rows for blocks [start, stop) of a trace."""
+    blocks_per_batch = max(1, batch_size // LINE_SIZE)
+    with TraceReader(file_path) as trace:
+        stop = len(trace) if stop is None else min(stop, len(trace))
+        for first in range(start, stop, blocks_per_batch):
+            last = min(first + blocks_per_batch, stop)
+            # explode_blocks copies, so a batch never pins the mapping
+            address, value, timestamp = explode_blocks(trace[first:last], first + timestamp_offset)
+            yield AddressBatch(address, value, timestamp, first, last)
+
+
+def iter_block_batches(file_path, batch_size, start=0, stop=None, timestamp_offset=0):
+    """Yield BlockBatch columns of batch_size whole writebacks for blocks [start, stop) of a trace."""
+    with TraceReader(file_path) as trace:
+        stop = len(trace) if stop is None else min(stop, len(trace))
+        for first in range(start, stop, max(1, batch_size)):
+            last = min(first + max(1, batch_size), stop)
+            blocks = trace[first:last]
+            timestamp = np.arange(first + timestamp_offset, last + timestamp_offset, dtype=np.int64)
+            yield BlockBatch(blocks['address'].copy(), blocks['data'].copy(), timestamp, first, last)
+
+
+def follow_block_batches(file_path, batch_size, start=0, timestamp_offset=0, poll_interval=0.5, idle_timeout=None):
+    """Yield BlockBatch columns of up to batch_size writebacks as they are appended to a trace, like tail -f.
+
+    A regular file is read from block start and polled for growth. A named pipe is read until every
+    writer closed it, its first record is numbered start. Returns after idle_timeout seconds without
+    new data, or never when idle_timeout is None.
+    """
+    batch_size = max(1, batch_size)
+    with open(file_path, 'rb', buffering=0) as fp:
+        is_pipe = stat.S_ISFIFO(os.fstat(fp.fileno()).st_mode)
+        if not is_pipe:
+            fp.seek(start * BLOCK_SIZE)
+
+        pending = bytearray()  # Bytes of a record gem5 has not finished writing yet
+        first = start
+        idle_since = time.monotonic()
+        while True:
+            chunk = fp.read(batch_size * BLOCK_SIZE - len(pending))
+            if not chunk:
+                if is_pipe or (idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout):
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            idle_since = time.monotonic()
+            pending += chunk
+            count = len(pending) // BLOCK_SIZE
+            if not count:
+                continue
+            blocks = decode_blocks(bytes(pending[:count * BLOCK_SIZE]))
+            del pending[:count * BLOCK_SIZE]
+            timestamp = np.arange(first + timestamp_offset, first + count + timestamp_offset, dtype=np.int64)
+            yield BlockBatch(blocks['address'].copy(), blocks['data'].copy(), timestamp, first, first + count)
+            first += count
+
+
+def follow_batches(file_path, batch_size, start=0, timestamp_offset=0, poll_interval=0.5, idle_timeout=None):
+    """Like iter_batches, but keeps following the trace as it grows, see follow_block_batches."""
+    for batch in follow_block_batches(file_path, batch_size // LINE_SIZE, start, timestamp_offset,
+                                      poll_interval, idle_timeout):
+        yield explode_block_batch(batch)
@@ -0,0 +1,200 @@
+import json
+
+import numpy as np
+
+from trace_reader import iter_block_batches, follow_block_batches
+
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def mix64(x, seed=0):
+    """SplitMix64 finalizer of every uint64 in x, a cheap well-spread hash."""
+    x = np.asarray(x, dtype=np.uint64) + np.uint64(_GOLDEN * (seed + 1) & (2**64 - 1))
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def bit_length(x):
+    """Number of significant bits of every uint64 in x."""
+    x = np.asarray(x, dtype=np.uint64).copy()
+    length = np.zeros(x.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = x >= np.uint64(1 << shift)
+        length[high] += shift
+        x[high] >>= np.uint64(shift)
+    return length + (x > 0)
+
+
+class CountMinSketch:
+    """Count-min sketch of per-line writeback counts, estimates never undercount."""
+
+    def __init__(self, width=2**16, depth=4):
+        self.width = 1 << (max(1, width) - 1).bit_length()  # Power of two, so a mask picks the column
+        self.depth = depth
+        self.table = np.zeros((depth, self.width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, lines):
+        return [mix64(lines, row) & np.uint64(self.width - 1) for row in range(self.depth)]
+
+    def update(self, lines, counts):
+        """Add counts to distinct lines."""
+        for row, columns in enumerate(self._columns(lines)):
+            self.table[row] += np.bincount(columns.astype(np.int64), weights=counts,
+                                           minlength=self.width).astype(np.int64)
+        self.total += int(counts.sum())
+
+    def estimate(self, lines):
+        """Upper bound on the writebacks of every line in lines."""
+        estimate = np.full(len(lines), np.iinfo(np.int64).max, dtype=np.int64)
+        for row, columns in enumerate(self._columns(lines)):
+            np.minimum(estimate, self.table[row][columns.astype(np.int64)], out=estimate)
+        return estimate
+
+    @property
+    def max_error(self):
+        """Overcount bound e * total / width, exceeded with probability at most exp(-depth)."""
+        return int(np.ceil(np.e * self.total / self.width))
+
+
+class HyperLogLog:
+    """HyperLogLog estimate of the number of distinct lines, 2**precision one-byte registers."""
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, lines):
+        h = mix64(lines, seed=-1)
+        low_bits = 64 - self.precision
+        index = (h >> np.uint64(low_bits)).astype(np.int64)
+        rank = low_bits + 1 - bit_length(h & np.uint64((1 << low_bits) - 1))
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: linear counting
+            estimate = m * np.log(m / zeros)
+        return float(estimate)
+
+
+class TraceStats:
+    """Single-pass, bounded-memory writeback statistics of a trace, fed BlockBatch columns in order."""
+
+    def __init__(self, top_k=32, window=2**16, width=2**16, depth=4, precision=14):
+        self.top_k = top_k
+        self.window = window  # Blocks per window of the rate report
+        self.sketch = CountMinSketch(width, depth)
+        self.distinct = HyperLogLog(precision)
+        # Heavy hitter candidates, a few times top_k so late risers can still make it into the top
+        self.candidates = np.empty(0, dtype=np.uint64)
+        self.capacity = 4 * top_k
+        self.blocks = 0
+        self.next_block = 0  # One past the last block index seen
+        self.windows = []
+        # Exact per-line counts of the window being filled, at most window entries
+        self._window_index = None
+        self._window_lines = np.empty(0, dtype=np.uint64)
+        self._window_counts = np.empty(0, dtype=np.int64)
+
+    def update(self, batch):
+        """Account for the writebacks of a BlockBatch."""
+        window_index = batch.timestamp // self.window
+        bounds = np.flatnonzero(np.diff(window_index)) + 1
+        for lo, hi in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(window_index)]))):
+            self._add(int(window_index[lo]), batch.address[lo:hi])
+        if len(batch.timestamp):
+            self.next_block = int(batch.timestamp[-1]) + 1
+
+    def _add(self, window_index, addresses):
+        if self._window_index is not None and window_index != self._window_index:
+            self._close_window()
+        self._window_index = window_index
+
+        lines, counts = np.unique(addresses, return_counts=True)
+        self.sketch.update(lines, counts)
+        self.distinct.update(lines)
+        self.blocks += len(addresses)
+
+        candidates = np.union1d(self.candidates, lines)
+        if len(candidates) > self.capacity:
+            keep = np.argpartition(-self.sketch.estimate(candidates), self.capacity - 1)[:self.capacity]
+            candidates = np.sort(candidates[keep])
+        self.candidates = candidates
+
+        merged, inverse = np.unique(np.concatenate((self._window_lines, lines)), return_inverse=True)
+        self._window_counts = np.bincount(inverse, weights=np.concatenate((self._window_counts, counts)),
+                                          minlength=len(merged)).astype(np.int64)
+        self._window_lines = merged
+
+    def _window_report(self):
+        # Every block is one writeback, so the window's writeback count is just its length; how
+        # spread out or concentrated they are is what tells windows apart
+        hottest = int(np.argmax(self._window_counts))
+        start = self._window_index * self.window
+        return {
+            'start': start,
+            'stop': start + self.window,
+            'distinct_lines': len(self._window_lines),
+            'hottest_line': int(self._window_lines[hottest]),
+            'hottest_line_writebacks': int(self._window_counts[hottest]),
+            'hottest_line_share': float(self._window_counts[hottest] / self._window_counts.sum()),
+        }
+
+    def _close_window(self):
+        self.windows.append(self._window_report())
+        self._window_index = None
+        self._window_lines = np.empty(0, dtype=np.uint64)
+        self._window_counts = np.empty(0, dtype=np.int64)
+
+    def line_counts(self, lines):
+        """Estimated writebacks of each line address, never below the true count."""
+        return self.sketch.estimate(np.asarray(lines, dtype=np.uint64))
+
+    def top_lines(self):
+        """The top_k hottest lines as (line address, estimated writebacks), hottest first."""
+        estimate = self.sketch.estimate(self.candidates)
+        order = np.argsort(-estimate, kind='stable')[:self.top_k]
+        return list(zip(self.candidates[order].tolist(), estimate[order].tolist()))
+
+    def to_dict(self):
+        windows = list(self.windows)
+        if self._window_index is not None:
+            # The window being filled is reported up to the last block seen
+            windows.append(self._window_report())
+            windows[-1]['stop'] = min(windows[-1]['stop'], self.next_block)
+        return {
+            'blocks': self.blocks,
+            'distinct_lines': round(self.distinct.estimate()),
+            'top_lines': [{'line': line, 'writebacks': count} for line, count in self.top_lines()],
+            'count_min': {'width': self.sketch.width, 'depth': self.sketch.depth,
+                          'max_error': self.sketch.max_error},
+            'window': self.window,
+            'windows': windows,
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def collect_stats(file_path, start=0, stop=None, follow=False, poll_interval=1.0, idle_timeout=None, **options):
+    """One pass of TraceStats over blocks [start, stop) of a trace, or over a growing trace with follow."""
+    stats = TraceStats(**options)
+    if follow:
+        batches = follow_block_batches(file_path, stats.window, start, 0, poll_interval, idle_timeout)
+    else:
+        batches = iter_block_batches(file_path, stats.window, start, stop)
+    for batch in batches:
+        stats.update(batch)
+    return stats
+
+
+if __name__ == "__main__":
+    stats = collect_stats("../data/data.log")
+    stats.write_json("../data/data.stats.json")